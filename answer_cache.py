@@ -0,0 +1,210 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import faiss
+import numpy as np
+
+ANSWER_CACHE_PATH = "working_data/answer_cache.sqlite"
+DEFAULT_TTL = 24 * 3600.0
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_SIMILARITY = 0.95
+# Past questions compared per near-duplicate lookup
+SIMILAR_CANDIDATES = 8
+
+def normalize_query(query):
+    """Case, runs of whitespace and trailing punctuation don't change the question."""
+    return re.sub(r"\s+", " ", query.lower()).strip(" ?!.")
+
+class AnswerCache:
+    """
+    Answers to RAG questions, keyed by (model, retrieved doc IDs in order, normalized
+    query), in a sqlite file so they survive restarts and are shared by every
+    chat_with_knowledge.py run.
+
+    With similarity > 0, a question that isn't an exact repeat can still hit: its
+    embedding is compared with past questions' in a small in-memory IndexFlatIP, and a
+    past question at least that similar (cosine), asked of the same model with the same
+    retrieved docs, returns its answer. Entries expire after ttl seconds, the least
+    recently used are evicted beyond max_entries, and everything is dropped when the
+    index fingerprint (index_utils.file_signature of faiss.index) changes, because an
+    update can change a document's text without changing its ID.
+
+    source names what the answers were retrieved from (the fingerprinted file), so a
+    faiss index and an --embeddings store can share the file without one's fingerprint
+    wiping the other's answers: rows, fingerprint and max_entries are all per source.
+    """
+    def __init__(self, path=ANSWER_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 similarity=DEFAULT_SIMILARITY, source="index"):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.source = source
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " id INTEGER PRIMARY KEY, key BLOB UNIQUE, source TEXT, model TEXT, doc_key TEXT, query TEXT,"
+            " answer TEXT, vector BLOB, created REAL, used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS answers_used ON answers (source, used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+        # model -> IndexIDMap2(IndexFlatIP) over unit-length question vectors, ids = answers.id
+        self.vectors = {}
+        for row_id, model, blob in self.db.execute(
+            "SELECT id, model, vector FROM answers WHERE source = ? AND vector IS NOT NULL", (source,)
+        ):
+            self._add_vector(model, row_id, np.frombuffer(blob, dtype=np.float32))
+
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def doc_key(doc_ids):
+        return ",".join(str(int(i)) for i in doc_ids)
+
+    def key(self, model, doc_ids, query):
+        text = "\0".join([self.source, model, self.doc_key(doc_ids), normalize_query(query)])
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    @staticmethod
+    def unit(vector):
+        vector = np.array(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def check_fingerprint(self, fingerprint):
+        """Drop this source's answers if its index has changed since they were cached."""
+        fingerprint = json.dumps(fingerprint)
+        meta_key = "fingerprint:" + self.source
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (meta_key,)).fetchone()
+            if row and row[0] == fingerprint:
+                return
+            if row:
+                self.db.execute("DELETE FROM answers WHERE source = ?", (self.source,))
+                self.vectors = {}
+                self.invalidations += 1
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (meta_key, fingerprint))
+            self.db.commit()
+
+    def get(self, model, doc_ids, query, vector=None):
+        """
+        (answer, "exact" or "similar") for a question, or (None, None). vector is the
+        query embedding; without it only exact repeats hit.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, answer FROM answers WHERE key = ? AND created > ?",
+                (self.key(model, doc_ids, query), now - self.ttl)
+            ).fetchone()
+            match = "exact" if row else None
+            if row is None and vector is not None and self.similarity > 0 and model in self.vectors:
+                row = self._similar(model, doc_ids, self.unit(vector), now)
+                match = "similar" if row else None
+            if row is None:
+                self.misses += 1
+                return None, None
+            self.db.execute("UPDATE answers SET used = ? WHERE id = ?", (now, row[0]))
+            self.db.commit()
+            self.hits += 1
+            if match == "similar":
+                self.similar_hits += 1
+            return row[1], match
+
+    def _similar(self, model, doc_ids, vector, now):
+        """Caller holds self.lock."""
+        index = self.vectors[model]
+        if index.ntotal == 0 or index.d != vector.shape[1]:
+            return None
+        scores, ids = index.search(vector, min(SIMILAR_CANDIDATES, index.ntotal))
+        doc_key = self.doc_key(doc_ids)
+        for score, row_id in zip(scores[0].tolist(), ids[0].tolist()):
+            if row_id < 0 or score < self.similarity:
+                break
+            row = self.db.execute(
+                "SELECT id, answer FROM answers WHERE id = ? AND doc_key = ? AND created > ?",
+                (row_id, doc_key, now - self.ttl)
+            ).fetchone()
+            if row:
+                return row
+        return None
+
+    def put(self, model, doc_ids, query, answer, vector=None):
+        now = time.time()
+        unit = None if vector is None else self.unit(vector)
+        key = self.key(model, doc_ids, query)
+        with self.lock:
+            # A repeat replaces the old answer; its vector goes with it
+            old = self.db.execute("SELECT id FROM answers WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._remove_vectors([old[0]])
+            cur = self.db.execute(
+                "INSERT OR REPLACE INTO answers (key, source, model, doc_key, query, answer, vector, created, used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, self.source, model, self.doc_key(doc_ids), query, answer,
+                 None if unit is None else unit.tobytes(), now, now)
+            )
+            if unit is not None:
+                self._add_vector(model, cur.lastrowid, unit[0])
+            self._evict(now)
+            self.db.commit()
+
+    def _add_vector(self, model, row_id, vector):
+        """Caller holds self.lock (or is __init__)."""
+        index = self.vectors.get(model)
+        if index is None or index.d != len(vector):
+            index = self.vectors[model] = faiss.IndexIDMap2(faiss.IndexFlatIP(len(vector)))
+        index.add_with_ids(vector.reshape(1, -1), np.array([row_id], dtype=np.int64))
+
+    def _evict(self, now):
+        """Caller holds self.lock. Expired answers, then the least recently used beyond max_entries."""
+        stale = [row[0] for row in self.db.execute(
+            "SELECT id FROM answers WHERE source = ? AND created <= ?", (self.source, now - self.ttl)
+        )]
+        count = self.db.execute("SELECT COUNT(*) FROM answers WHERE source = ?", (self.source,)).fetchone()[0] - len(stale)
+        if count > self.max_entries:
+            stale += [row[0] for row in self.db.execute(
+                "SELECT id FROM answers WHERE source = ? AND created > ? ORDER BY used LIMIT ?",
+                (self.source, now - self.ttl, count - self.max_entries)
+            )]
+            self.evictions += count - self.max_entries
+        if not stale:
+            return
+        self.db.executemany("DELETE FROM answers WHERE id = ?", [(i,) for i in stale])
+        self._remove_vectors(stale)
+
+    def _remove_vectors(self, row_ids):
+        """Caller holds self.lock. remove_ids skips ids an index doesn't have."""
+        remove = np.array(row_ids, dtype=np.int64)
+        for index in self.vectors.values():
+            index.remove_ids(remove)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "source": self.source,
+                "entries": self.db.execute("SELECT COUNT(*) FROM answers WHERE source = ?", (self.source,)).fetchone()[0],
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "similarity": self.similarity,
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Load-test load_balancer.py (or anything speaking Ollama's API) with in-process
+clients and report latency percentiles, throughput and errors as JSON, so routing
+and proxy changes can be compared run to run. Point the balancer at mock_ollama.py
+hosts for numbers that don't depend on GPUs.
+
+Closed loop (--rate 0): --concurrency clients each send their next request as soon
+as the last one finishes. Open loop (--rate N): requests start on a fixed schedule
+(or Poisson arrivals) whatever the responses do, and latency is measured from each
+request's scheduled time, so time spent waiting for a free client counts too.
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ENDPOINTS = {"chat": "/api/chat", "generate": "/api/generate", "embed": "/api/embed"}
+
+_local = threading.local()
+
+def session():
+    """One keep-alive session per client thread."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+def build_payload(args, i):
+    """Request i's body; --distinct > 0 cycles through that many different inputs (to exercise caches)."""
+    n = i % args.distinct if args.distinct > 0 else i
+    if args.endpoint == "embed":
+        return {"model": args.model, "input": [f"{args.prompt} #{n}.{j}" for j in range(args.batch)]}
+    body = {"model": args.model, "stream": args.stream}
+    if args.num_predict:
+        body["options"] = {"num_predict": args.num_predict}
+    if args.endpoint == "chat":
+        body["messages"] = [{"role": "user", "content": f"{args.prompt} #{n}"}]
+    else:
+        body["prompt"] = f"{args.prompt} #{n}"
+    return body
+
+def send(url, payload, scheduled, timeout):
+    """One request. latency and ttfb (first body byte) are measured from scheduled."""
+    result = {"status": None, "error": None, "latency": None, "ttfb": None, "bytes": 0, "eval_count": 0}
+    last_line = b""
+    try:
+        with session().post(url, json=payload, stream=True, timeout=timeout) as resp:
+            result["status"] = resp.status_code
+            for chunk in resp.iter_content(chunk_size=None):
+                if not chunk:
+                    continue
+                if result["ttfb"] is None:
+                    result["ttfb"] = time.monotonic() - scheduled
+                result["bytes"] += len(chunk)
+                last_line = (last_line + chunk)[-4096:]
+        result["latency"] = time.monotonic() - scheduled
+        if resp.status_code != 200:
+            result["error"] = str(resp.status_code)
+        else:
+            # The final (or only) JSON object carries Ollama's eval_count
+            try:
+                result["eval_count"] = json.loads(last_line.strip().rsplit(b"\n", 1)[-1]).get("eval_count") or 0
+            except ValueError:
+                pass
+    except Exception as e:
+        result["latency"] = time.monotonic() - scheduled
+        result["error"] = type(e).__name__
+    return result
+
+def run_closed(args, url, count, deadline):
+    """--concurrency clients in a loop until count requests are done or deadline passes."""
+    results = []
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def client():
+        while True:
+            i = next(counter)
+            if i >= count or time.monotonic() >= deadline:
+                return
+            result = send(url, build_payload(args, i), time.monotonic(), args.timeout)
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def run_open(args, url, count, deadline):
+    """Start requests at --rate per second on --concurrency clients; late starts still count from their slot."""
+    rng = random.Random(args.seed)
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        start = time.monotonic()
+        due = start
+        for i in range(count):
+            due += rng.expovariate(args.rate) if args.arrivals == "poisson" else 1.0 / args.rate
+            if due >= deadline:
+                break
+            time.sleep(max(0.0, due - time.monotonic()))
+            futures.append(executor.submit(send, url, build_payload(args, i), due, args.timeout))
+    return [f.result() for f in futures]
+
+def percentiles(values):
+    """Nearest-rank p50/p95/p99 plus mean/min/max, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    def rank(p):
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)] * 1000
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": sum(values) / len(values) * 1000,
+        "min": values[0] * 1000,
+        "max": values[-1] * 1000
+    }
+
+def summarize(args, results, elapsed):
+    ok = [r for r in results if r["error"] is None]
+    errors = Counter(r["error"] for r in results if r["error"] is not None)
+    tokens = sum(r["eval_count"] for r in ok)
+    return {
+        "label": args.label,
+        "config": {
+            "url": args.url, "endpoint": args.endpoint, "model": args.model, "stream": args.stream,
+            "concurrency": args.concurrency, "rate": args.rate, "arrivals": args.arrivals,
+            "batch": args.batch, "distinct": args.distinct, "num_predict": args.num_predict,
+            "warmup": args.warmup, "seed": args.seed
+        },
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": dict(errors),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "duration_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+        "ttfb_ms": percentiles([r["ttfb"] for r in ok if r["ttfb"] is not None]),
+        "bytes_received": sum(r["bytes"] for r in results),
+        "tokens_per_second": tokens / elapsed if elapsed and tokens else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the load balancer and report JSON.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="Balancer base URL.")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="chat")
+    parser.add_argument("--model", default="qwen:0.5b")
+    parser.add_argument("--stream", action="store_true", help="Ask chat/generate for a streamed reply.")
+    parser.add_argument("--prompt", default="Why is the sky blue?",
+                        help="Prompt or embed input; a request number is appended to each.")
+    parser.add_argument("--num-predict", type=int, default=None, help="options.num_predict for chat/generate.")
+    parser.add_argument("--batch", type=int, default=1, help="Inputs per /api/embed request.")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="Cycle through this many different inputs (0: every request is new).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Client threads.")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Requests started per second (open loop); 0 for closed loop.")
+    parser.add_argument("--arrivals", choices=["uniform", "poisson"], default="uniform",
+                        help="Open-loop spacing between request starts.")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests (0: as many as --duration allows).")
+    parser.add_argument("--duration", type=float, default=0.0, help="Stop starting requests after this many seconds.")
+    parser.add_argument("--warmup", type=int, default=0, help="Unmeasured requests sent first.")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for Poisson arrivals.")
+    parser.add_argument("--label", default=None, help="Name for this run in the report.")
+    parser.add_argument("--balancer-stats", action="store_true",
+                        help="Include the balancer's GET /stats after the run in the report.")
+    parser.add_argument("--output", default="-", help='Where to write the JSON report ("-" for stdout).')
+    args = parser.parse_args()
+    if args.requests <= 0 and args.duration <= 0:
+        parser.error("--requests 0 needs a --duration")
+
+    url = args.url.rstrip("/") + ENDPOINTS[args.endpoint]
+    run = run_open if args.rate > 0 else run_closed
+
+    if args.warmup:
+        run(args, url, args.warmup, float("inf"))
+
+    started = time.monotonic()
+    deadline = started + args.duration if args.duration > 0 else float("inf")
+    results = run(args, url, args.requests if args.requests > 0 else sys.maxsize, deadline)
+    report = summarize(args, results, time.monotonic() - started)
+
+    if args.balancer_stats:
+        try:
+            report["balancer_stats"] = requests.get(args.url.rstrip("/") + "/stats", timeout=10).json()
+        except Exception as e:
+            report["balancer_stats"] = {"error": str(e)}
+
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"[DEBUG] Wrote report for {report['requests']} requests to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
+
+# python3 bench_balancer.py --endpoint chat --stream --concurrency 16 --requests 500
+# python3 bench_balancer.py --endpoint embed --rate 200 --duration 30 --output run.json
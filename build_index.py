@@ -1,66 +1,356 @@
 #!/usr/bin/env python3
 
+import argparse
+import itertools
 import sys
 import json
-import faiss
+import tempfile
 import numpy as np
 import os
 
-def main():
-    # Make sure our output directory exists
-    output_dir = "working_data"
-    os.makedirs(output_dir, exist_ok=True)
+import embedding_store
+import index_utils
+import lexical_index
+import metadata_store
+
+DEFAULT_CHUNK_ROWS = 16384
+DEFAULT_TRAIN_SIZE = 100000
+
+def doc_metadata(doc):
+    # Store metadata (filename, text, etc.)
+    # You can store more keys if needed
+    meta = {
+        "filename": doc.get("filename", ""),
+        "text": doc.get("text", "")
+    }
+    # Chunked documents (chunk_docs.py) keep where they came from in the file
+    for key in ("chunk", "start", "end"):
+        if key in doc:
+            meta[key] = doc[key]
+    return meta
 
-    embeddings = []
+def doc_ids(metadata_list):
+    return np.array(
+        [index_utils.doc_id(meta["filename"], meta.get("chunk", 0)) for meta in metadata_list],
+        dtype=np.int64
+    )
+
+def iter_jsonl_chunks(lines, chunk_rows):
+    """
+    Yield (vectors, metadata, deleted filenames) chunks of up to chunk_rows vectors
+    from embedded_docs.jsonl lines. vectors is a view of one float32 buffer that gets
+    refilled for the next chunk, so use it before asking for another; it is None if
+    the input had only deletion records.
+    """
+    buf = None
     metadata_list = []
+    deleted = []
 
-    # Read JSONL from stdin
-    for line in sys.stdin:
+    for line in lines:
         line = line.strip()
         if not line:
             continue
-        
+
         doc = json.loads(line)
+        if doc.get("deleted"):
+            deleted.append(doc.get("filename", ""))
+            continue
         # doc must contain "embedding" as a float array
         embedding = doc.get("embedding", [])
         if not embedding:
             continue
-        
+
+        if buf is None:
+            buf = np.empty((chunk_rows, len(embedding)), dtype=np.float32)
         # Convert to float32 for Faiss
-        embeddings.append(embedding)
-
-        # Store metadata (filename, text, etc.)
-        # You can store more keys if needed
-        metadata_list.append({
-            "filename": doc.get("filename", ""),
-            "text": doc.get("text", "")
-        })
-
-    # Convert to numpy array
-    emb_array = np.array(embeddings, dtype=np.float32)
-    if len(emb_array) == 0:
+        buf[len(metadata_list)] = embedding
+        metadata_list.append(doc_metadata(doc))
+
+        if len(metadata_list) == chunk_rows:
+            yield buf, metadata_list, deleted
+            metadata_list, deleted = [], []
+
+    if metadata_list:
+        yield buf[:len(metadata_list)], metadata_list, deleted
+    elif deleted:
+        yield None, [], deleted
+
+def iter_store_chunks(prefix, chunk_rows):
+    """Like iter_jsonl_chunks, for an embed_docs.py --format f32 store; vectors are memmap views."""
+    vectors = embedding_store.open_vectors(prefix)
+    deleted = list(embedding_store.iter_deleted(prefix))
+    if deleted:
+        yield None, [], deleted
+    metadata_list = []
+    # Rows past the manifest count were never finished, so stop at the vectors
+    for row, doc in zip(range(len(vectors)), embedding_store.iter_metadata(prefix)):
+        metadata_list.append(doc_metadata(doc))
+        if len(metadata_list) == chunk_rows:
+            yield vectors[row + 1 - chunk_rows:row + 1], metadata_list, []
+            metadata_list = []
+    if metadata_list:
+        yield vectors[len(vectors) - len(metadata_list):], metadata_list, []
+
+class Reservoir:
+    """
+    A uniform random sample of up to `size` rows from a stream of chunks (Algorithm R).
+    The buffer doubles as rows arrive, so a small corpus doesn't allocate `size` rows.
+    """
+    def __init__(self, size, d, seed=1234):
+        self.size = size
+        self.rows = np.empty((0, d), dtype=np.float32)
+        self.seen = 0
+        self.rng = np.random.default_rng(seed)
+
+    def offer(self, chunk):
+        size = self.size
+        fill = min(max(size - self.seen, 0), len(chunk))
+        if self.seen + fill > len(self.rows):
+            grown = np.empty((min(size, max(2 * len(self.rows), self.seen + fill)), self.rows.shape[1]), dtype=np.float32)
+            grown[:self.seen] = self.rows[:self.seen]
+            self.rows = grown
+        self.rows[self.seen:self.seen + fill] = chunk[:fill]
+        rest = chunk[fill:]
+        if len(rest):
+            # Row number i replaces a random slot with probability size / (i + 1)
+            positions = np.arange(self.seen + fill, self.seen + len(chunk))
+            slots = self.rng.integers(0, positions + 1)
+            keep = slots < size
+            self.rows[slots[keep]] = rest[keep]
+        self.seen += len(chunk)
+
+    def sample(self):
+        return self.rows[:min(self.seen, self.size)]
+
+class DocumentStores:
+    """
+    The metadata store and, unless turned off, the BM25 index (lexical_index.py),
+    written side by side under the same doc IDs.
+    """
+    def __init__(self, output_dir, lexical=True, update=False):
+        self.metadata = metadata_store.MetadataWriter(os.path.join(output_dir, "faiss_metadata.sqlite"), update)
+        self.lexical = None
+        if lexical:
+            self.lexical = lexical_index.LexicalWriter(os.path.join(output_dir, "lexical_index.sqlite"), update)
+
+    def write(self, ids, metadata_list):
+        self.metadata.write(ids, metadata_list)
+        if self.lexical:
+            self.lexical.write(ids, metadata_list)
+
+    def ids_for_file(self, filename):
+        return self.metadata.ids_for_file(filename)
+
+    def delete(self, ids):
+        self.metadata.delete(ids)
+        if self.lexical:
+            self.lexical.delete(ids)
+
+    def close(self):
+        self.metadata.close()
+        if self.lexical:
+            self.lexical.close()
+
+def update_index(args, chunks, output_dir):
+    """
+    Apply a feed of changed documents to the saved index instead of rebuilding it.
+    Every chunk of a file that appears (or is marked deleted) is removed first, so a
+    file that got shorter leaves none of its old chunks behind; new chunks are added
+    under their doc IDs.
+    """
+    index_path = os.path.join(output_dir, "faiss.index")
+    params_path = os.path.join(output_dir, "faiss_index_params.json")
+    metadata_path = os.path.join(output_dir, "faiss_metadata.sqlite")
+
+    if not os.path.exists(metadata_path):
+        print("This index was built before the metadata store; rebuild it once without --update.")
+        sys.exit(1)
+    # Writable, so not memory-mapped
+    index, params = index_utils.load_index(index_path, params_path, mmap=False)
+    # Keep the BM25 index in step if this index has one
+    lexical = os.path.exists(os.path.join(output_dir, "lexical_index.sqlite"))
+    metadata_out = DocumentStores(output_dir, lexical, update=True)
+
+    cleared = set()
+
+    def clear(filename):
+        if filename in cleared:
+            return 0
+        cleared.add(filename)
+        ids = metadata_out.ids_for_file(filename)
+        if ids:
+            try:
+                index.remove_ids(np.array(ids, dtype=np.int64))
+            except RuntimeError:
+                print(f"A {params.get('factory')} index can't remove vectors; rebuild it without --update.")
+                sys.exit(1)
+            metadata_out.delete(ids)
+        return len(ids)
+
+    added = removed = 0
+    for vectors, metadata_list, deleted in chunks:
+        for filename in deleted:
+            removed += clear(filename)
+        if vectors is None:
+            continue
+        for meta in metadata_list:
+            removed += clear(meta["filename"])
+        ids = doc_ids(metadata_list)
+        index.add_with_ids(index_utils.normalize(vectors, params["metric"]), ids)
+        metadata_out.write(ids, metadata_list)
+        added += len(ids)
+
+    print(f"Removed {removed} and added {added} vectors; index now holds {index.ntotal}.")
+
+    metadata_out.close()
+    params["ntotal"] = index.ntotal
+    index_utils.save_params(params, params_path)
+    index_utils.write_index(index, index_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a Faiss index from embedded documents.")
+    parser.add_argument("--embeddings", default=None,
+                        help="Read an embed_docs.py --format f32 store with this prefix instead of JSONL on stdin.")
+    parser.add_argument("--index-type", choices=index_utils.INDEX_TYPES, default="flat",
+                        help="flat: exact. ivf: inverted lists (nlist/nprobe). hnsw: graph (M/efConstruction/efSearch). "
+                             "ivfpq: inverted lists over product-quantized codes, smallest and least exact.")
+    parser.add_argument("--metric", choices=index_utils.METRICS, default="l2",
+                        help="cosine normalizes vectors and ranks by inner product (higher is closer).")
+    parser.add_argument("--factory", default=None,
+                        help='Raw faiss.index_factory string instead of --index-type, e.g. "IVF4096,PQ64x4".')
+    parser.add_argument("--nlist", type=int, default=0,
+                        help="Inverted lists for ivf/ivfpq (0 = about 4*sqrt(number of vectors)).")
+    parser.add_argument("--hnsw-m", type=int, default=index_utils.DEFAULT_HNSW_M,
+                        help="Neighbours per HNSW node.")
+    parser.add_argument("--ef-construction", type=int, default=index_utils.DEFAULT_EF_CONSTRUCTION,
+                        help="HNSW build-time search depth.")
+    parser.add_argument("--pq-m", type=int, default=0,
+                        help="PQ sub-quantizers for ivfpq; must divide the dimension (0 = largest divisor up to 64).")
+    parser.add_argument("--pq-bits", type=int, default=index_utils.DEFAULT_PQ_BITS,
+                        help="Bits per PQ sub-quantizer code.")
+    parser.add_argument("--nprobe", type=int, default=index_utils.DEFAULT_NPROBE,
+                        help="Saved query-time default: inverted lists visited per search.")
+    parser.add_argument("--ef-search", type=int, default=index_utils.DEFAULT_EF_SEARCH,
+                        help="Saved query-time default: HNSW search depth.")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help="Vectors read and added per step; bounds memory along with --train-size.")
+    parser.add_argument("--train-size", type=int, default=DEFAULT_TRAIN_SIZE,
+                        help="Reservoir sample size used to train IVF/PQ indexes.")
+    parser.add_argument("--no-lexical", action="store_true",
+                        help="Don't build the BM25 index (lexical_index.sqlite) used by --mode lexical/hybrid queries.")
+    parser.add_argument("--update", action="store_true",
+                        help="Replace/delete the input's documents in the existing index instead of building a new one "
+                             "(index options are taken from the saved index).")
+    args = parser.parse_args()
+
+    # Make sure our output directory exists
+    output_dir = "working_data"
+    os.makedirs(output_dir, exist_ok=True)
+
+    if args.embeddings:
+        chunks = iter_store_chunks(args.embeddings, args.chunk_rows)
+    else:
+        chunks = iter_jsonl_chunks(sys.stdin, args.chunk_rows)
+    if args.update:
+        update_index(args, chunks, output_dir)
+        return
+
+    # Look ahead to the first vectors for the dimension (deletions mean nothing to a new index)
+    pending = []
+    for chunk in chunks:
+        if chunk[0] is not None:
+            pending.append(chunk)
+            break
+    if not pending:
         print("No embeddings found. Exiting...")
         return
+    chunks = itertools.chain(pending, chunks)
 
     # Build Faiss index
-    d = emb_array.shape[1]   # dimension
-    index = faiss.IndexFlatL2(d)
-    index.add(emb_array)
+    d = pending[0][0].shape[1]   # dimension
+
+    def new_index(n=None):
+        factory = args.factory or index_utils.factory_string(
+            args.index_type, d, args.nlist, args.hnsw_m, args.pq_m, args.pq_bits, n
+        )
+        return factory, index_utils.make_index(d, factory, args.metric, args.ef_construction)
+
+    # ivf/ivfpq are sized from the vector count, which is only known after the first pass
+    factory, index = new_index()
 
+    # Save metadata to the sqlite store (and the BM25 index) in the working_data subdirectory as we go
+    metadata_out = DocumentStores(output_dir, lexical=not args.no_lexical)
+    lexical_path = os.path.join(output_dir, "lexical_index.sqlite")
+    if args.no_lexical and os.path.exists(lexical_path):
+        # It would still describe the previous build's documents
+        os.remove(lexical_path)
+
+    if index.is_trained:
+        for vectors, metadata_list, _ in chunks:
+            if vectors is None:
+                continue
+            ids = doc_ids(metadata_list)
+            index.add_with_ids(index_utils.normalize(vectors, args.metric), ids)
+            metadata_out.write(ids, metadata_list)
+    else:
+        # Nothing can be added before training, so sample on the way through and add
+        # in a second pass over the vectors on disk (spooled there if they came from stdin)
+        reservoir = Reservoir(args.train_size, d)
+        spool = None if args.embeddings else tempfile.NamedTemporaryFile(dir=output_dir, suffix=".f32")
+        id_chunks = []
+        for vectors, metadata_list, _ in chunks:
+            if vectors is None:
+                continue
+            reservoir.offer(vectors)
+            id_chunks.append(doc_ids(metadata_list))
+            metadata_out.write(id_chunks[-1], metadata_list)
+            if spool:
+                spool.write(vectors.tobytes())
+        ids = np.concatenate(id_chunks)
+
+        factory, index = new_index(reservoir.seen)
+        print(f"Training {factory} on {len(reservoir.sample())} of {reservoir.seen} vectors...")
+        index.train(index_utils.normalize(reservoir.sample(), args.metric))
+
+        if spool:
+            spool.flush()
+            stored = np.memmap(spool.name, dtype=np.float32, mode="r", shape=(reservoir.seen, d))
+        else:
+            stored = embedding_store.open_vectors(args.embeddings)[:reservoir.seen]
+        for start in range(0, len(stored), args.chunk_rows):
+            index.add_with_ids(
+                index_utils.normalize(stored[start:start + args.chunk_rows], args.metric),
+                ids[start:start + args.chunk_rows]
+            )
+        if spool:
+            del stored
+            spool.close()
+
+    metadata_out.close()
     print(f"Indexed {index.ntotal} vectors of dimension {d}.")
 
-    # Save index to disk in the working_data subdirectory
-    index_path = os.path.join(output_dir, "faiss.index")
-    faiss.write_index(index, index_path)
+    # Save what the query tools need to search it the same way
+    index_utils.save_params({
+        "index_type": "custom" if args.factory else args.index_type,
+        "factory": factory,
+        "metric": args.metric,
+        "dim": d,
+        "ntotal": index.ntotal,
+        "efConstruction": args.ef_construction,
+        "nprobe": args.nprobe,
+        "efSearch": args.ef_search
+    }, os.path.join(output_dir, "faiss_index_params.json"))
+
+    # Save index to disk in the working_data subdirectory, last (see index_utils.write_index)
+    index_utils.write_index(index, os.path.join(output_dir, "faiss.index"))
 
-    # Save metadata to a JSON file in the working_data subdirectory
-    metadata_path = os.path.join(output_dir, "faiss_metadata.json")
-    with open(metadata_path, "w") as mfile:
-        json.dump(metadata_list, mfile, ensure_ascii=False, indent=2)
-    
     print(f"Index and metadata saved to '{output_dir}' folder.")
 
 if __name__ == "__main__":
     main()
 
-# (IndexFlatL2) to approximate search (IndexHNSWFlat, IndexIVFPQ, etc.) 
+# cat working_data/embedded_docs.jsonl | python3 build_index.py
+# python3 build_index.py --embeddings working_data/embedded_docs
+# python3 build_index.py --embeddings working_data/embedded_docs --index-type ivf --nlist 1024 --train-size 200000
+# python3 build_index.py --embeddings working_data/embedded_docs --index-type hnsw --metric cosine --ef-search 128
+# cat working_data/changed_embedded_docs.jsonl | python3 build_index.py --update
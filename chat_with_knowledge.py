@@ -2,10 +2,23 @@
 
 import argparse
 import json
+import os
 import requests
-import faiss
 import numpy as np
 import sys
+import time
+
+import answer_cache
+import embedding_store
+import index_utils
+import lexical_index
+import metadata_store
+
+# Faiss fills rows it has no hit for with id -1 and the largest float32 distance
+SENTINEL_DISTANCE = float(np.finfo(np.float32).max)
+CHARS_PER_TOKEN = 4
+DEFAULT_CONTEXT_TOKENS = 2048
+CHAT_URL = "http://localhost:5000/api/chat"
 
 def debug_print(*args):
     """Utility for quick debug logs to stderr (so they don't mix with normal output)."""
@@ -48,26 +61,76 @@ def query_faiss_index(query_vector: np.ndarray, top_k: int, metadata_list, index
     distances, indices = index.search(query_vector_2d, top_k)
 
     results = []
-    for dist, idx in zip(distances[0], indices[0]):
+    ids = indices[0].tolist()
+    for dist, idx, meta in zip(distances[0].tolist(), ids, index_utils.metadata_for_many(metadata_list, ids)):
         # If distance is float max (~3.4028235e+38), it means no close match
-        meta = metadata_list[idx]
+        if meta is None or abs(dist) >= SENTINEL_DISTANCE:
+            continue
         results.append({
+            "id": idx,
             "distance": dist,
             "filename": meta.get("filename", ""),
             "text": meta.get("text", "")
         })
     return results
 
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting, about four characters per token."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def format_doc(doc: dict) -> str:
+    return f"[DOC] Filename: {doc['filename']}\nText: {doc['text']}"
+
+def build_context(docs: list, max_tokens: int = DEFAULT_CONTEXT_TOKENS, cutoff=None, metric: str = "l2"):
+    """
+    Pick the hits worth sending to the model, best first. Empty (-1 / float max) hits
+    and repeats of a document already taken are dropped, and so is anything past
+    cutoff: a largest distance for l2, a smallest similarity for cosine. Keyword-only
+    hybrid/lexical hits have no distance and always pass the cutoff. Then hits are
+    packed into max_tokens of context; one that doesn't fit is skipped for smaller
+    ones after it, except the best, which is cut to fit rather than dropped.
+    Returns (docs, stats).
+    """
+    kept = []
+    seen = set()
+    used = 0
+    stats = {"hits": len(docs), "empty": 0, "duplicates": 0, "past_cutoff": 0, "over_budget": 0}
+    for doc in docs:
+        # Keyword-only hits have no distance
+        dist = doc.get("distance")
+        if doc.get("id", 0) < 0 or (dist is not None and abs(dist) >= SENTINEL_DISTANCE):
+            stats["empty"] += 1
+            continue
+        # The same chunk under its ID, or the same text (older builds repeat documents)
+        keys = {doc.get("id"), (doc["filename"], doc["text"])} - {None}
+        if keys & seen:
+            stats["duplicates"] += 1
+            continue
+        if cutoff is not None and dist is not None and (dist < cutoff if metric == "cosine" else dist > cutoff):
+            stats["past_cutoff"] += 1
+            continue
+        cost = estimate_tokens(format_doc(doc))
+        if used + cost > max_tokens:
+            if kept:
+                stats["over_budget"] += 1
+                continue
+            overhead = estimate_tokens(format_doc({**doc, "text": ""}))
+            doc = {**doc, "text": doc["text"][:max(0, max_tokens - overhead) * CHARS_PER_TOKEN]}
+            cost = estimate_tokens(format_doc(doc))
+        seen |= keys
+        kept.append(doc)
+        used += cost
+    stats["kept"] = len(kept)
+    stats["context_tokens"] = used
+    return kept, stats
+
 # 3) Send to /api/chat
-def chat_with_context(model: str, user_query: str, docs: list) -> str:
+def build_chat_payload(model: str, user_query: str, docs: list, stream: bool = False, quiet: bool = False) -> dict:
     """
-    Combine user query + retrieved docs into a chat conversation, then
-    call your local chat endpoint for a final answer.
+    Combine user query + retrieved docs into a chat conversation.
     """
     # Flatten all retrieved docs into a single string or a bullet list
-    context_str = "\n\n".join([
-        f"[DOC] Filename: {d['filename']}\nText: {d['text']}" for d in docs
-    ])
+    context_str = "\n\n".join([format_doc(d) for d in docs])
 
     system_prompt = f"""You are a helpful assistant with access to the following retrieved documents:
 {context_str}
@@ -87,54 +150,215 @@ Please use this context to help answer user questions accurately.
       }
     ]
 
+    if not quiet:
+        debug_print(f"Prompt size: {len(system_prompt) + len(user_query)} chars, "
+                    f"~{estimate_tokens(system_prompt + user_query)} tokens, {len(docs)} docs")
+
     payload = {
         "model": model,
         "messages": messages,
-        "stream": False  # set to True if you want streaming
+        "stream": stream
     }
+    return payload
+
+def report_prompt_eval(resp: dict):
+    """What the model actually spent on the prompt, when Ollama reports it."""
+    if "prompt_eval_count" in resp:
+        debug_print(f"Prompt evaluated: {resp['prompt_eval_count']} tokens "
+                    f"in {resp.get('prompt_eval_duration', 0) / 1e6:.1f}ms")
+
+def chat_with_context(model: str, user_query: str, docs: list, session=None, quiet: bool = False,
+                      url: str = CHAT_URL) -> str:
+    """
+    Call the chat endpoint at url with the query and retrieved docs for a final answer.
+    session is a requests.Session to reuse connections (a server passes its own);
+    quiet skips the payload and response dumps.
+    """
+    payload = build_chat_payload(model, user_query, docs, quiet=quiet)
+    http = session or requests
 
-    debug_print("Sending POST to /api/chat with payload:", json.dumps(payload, indent=2))
-    response = requests.post("http://localhost:5000/api/chat", json=payload)
-    debug_print("Response status code from /api/chat:", response.status_code)
+    if not quiet:
+        debug_print("Sending POST to /api/chat with payload:", json.dumps(payload, indent=2))
+    response = http.post(url, json=payload)
+    if not quiet:
+        debug_print("Response status code from /api/chat:", response.status_code)
 
     if response.status_code != 200:
-        debug_print("Chat error. Full response:", response.text)
-        raise RuntimeError(f"Chat server returned {response.status_code}")
+        if not quiet:
+            debug_print("Chat error. Full response:", response.text)
+        raise RuntimeError(f"Chat server returned {response.status_code}: {response.text[:200]}")
 
     chat_resp = response.json()
-    debug_print("Full JSON response from /api/chat:", json.dumps(chat_resp, indent=2))
+    if not quiet:
+        debug_print("Full JSON response from /api/chat:", json.dumps(chat_resp, indent=2))
 
 
     return chat_resp
 
+def stream_chat_with_context(model: str, user_query: str, docs: list, on_token, url: str = CHAT_URL) -> dict:
+    """
+    Like chat_with_context, but with "stream": true: reads the NDJSON chunks as the
+    balancer relays them and calls on_token(text) for each piece of the answer.
+    Returns the final chunk (Ollama's totals) with the whole answer under "message"
+    and the client-side timings: time_to_first_token and total_time in seconds, and
+    tokens_per_second.
+    """
+    payload = build_chat_payload(model, user_query, docs, stream=True)
+    debug_print("Sending streaming POST to /api/chat with payload:", json.dumps(payload, indent=2))
+    started = time.monotonic()
+    first_token_at = None
+    pieces = []
+    chunks = 0
+    final = {}
+    with requests.post(url, json=payload, stream=True) as response:
+        if response.status_code != 200:
+            debug_print("Chat error. Full response:", response.text)
+            raise RuntimeError(f"Chat server returned {response.status_code}")
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(f"Chat server error: {chunk['error']}")
+            text = chunk.get("message", {}).get("content", "")
+            if text:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                pieces.append(text)
+                chunks += 1
+                on_token(text)
+            if chunk.get("done"):
+                final = chunk
+                break
+    finished = time.monotonic()
+
+    final["message"] = {"role": "assistant", "content": "".join(pieces)}
+    final["time_to_first_token"] = (first_token_at or finished) - started
+    final["total_time"] = finished - started
+    # Ollama's own count and timing if it sent them, else one token per chunk
+    if final.get("eval_count") and final.get("eval_duration"):
+        final["tokens_per_second"] = final["eval_count"] / (final["eval_duration"] / 1e9)
+    elif first_token_at is not None and finished > first_token_at:
+        final["tokens_per_second"] = (chunks - 1) / (finished - first_token_at)
+    else:
+        final["tokens_per_second"] = 0.0
+    return final
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--query", required=True, help="User's question to the LLM.")
     parser.add_argument("--model", default="qwen:0.5b", help="Model to use for embedding and chat.")
     parser.add_argument("--top_k", type=int, default=3, help="Retrieve this many docs for context.")
+    parser.add_argument("--embeddings", default=None,
+                        help="Search an embed_docs.py --format f32 store (memmapped) instead of the Faiss index.")
+    parser.add_argument("--mode", choices=lexical_index.MODES, default="vector",
+                        help="vector: Faiss search; lexical: BM25 keyword search (no embed call); "
+                             "hybrid: both, merged by reciprocal rank.")
+    parser.add_argument("--nprobe", type=int, default=None, help="Override the index's saved nprobe (ivf/ivfpq).")
+    parser.add_argument("--ef-search", type=int, default=None, help="Override the index's saved efSearch (hnsw).")
+    parser.add_argument("--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS,
+                        help="Budget for retrieved text in the prompt, in rough tokens (4 chars each).")
+    parser.add_argument("--cutoff", type=float, default=None,
+                        help="Leave out hits past this: a largest distance for l2 indexes, a smallest similarity for cosine "
+                             "(vector hits only; keyword-only hits from --mode lexical/hybrid are never cut).")
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="Answer repeat questions (same model, same retrieved docs) from a cache instead of /api/chat.")
+    parser.add_argument("--answer-cache-file", default=answer_cache.ANSWER_CACHE_PATH)
+    parser.add_argument("--answer-cache-ttl", type=float, default=answer_cache.DEFAULT_TTL,
+                        help="Seconds a cached answer stays valid.")
+    parser.add_argument("--answer-cache-entries", type=int, default=answer_cache.DEFAULT_MAX_ENTRIES,
+                        help="Answers kept before the least recently used are evicted.")
+    parser.add_argument("--answer-cache-similarity", type=float, default=answer_cache.DEFAULT_SIMILARITY,
+                        help="Also reuse the answer to a past question at least this similar (cosine of the "
+                             "query embeddings) that retrieved the same docs; 0 for exact repeats only.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print the answer as it is generated and report time to first token and tokens/sec.")
     args = parser.parse_args()
+    if args.embeddings and args.mode != "vector":
+        parser.error("--embeddings stores are searched by vector only")
+    started = time.monotonic()
 
-    debug_print(f"Query: {args.query}, Model: {args.model}, top_k: {args.top_k}")
+    debug_print(f"Query: {args.query}, Model: {args.model}, top_k: {args.top_k}, mode: {args.mode}")
 
-    # 1) Embed the user query
-    query_emb = get_query_embedding(args.query, args.model)
+    # 1) Embed the user query (keyword search doesn't need it)
+    query_emb = None
+    if args.mode != "lexical":
+        query_emb = get_query_embedding(args.query, args.model)
+    question_vector = query_emb
 
     # 2) Load Faiss index and metadata
-    debug_print("Loading Faiss index from working_data/faiss.index...")
-    index = faiss.read_index("working_data/faiss.index")
-    debug_print("Loading metadata from working_data/faiss_metadata.json...")
-    with open("working_data/faiss_metadata.json", "r") as f:
-        metadata_list = json.load(f)
+    index, params = None, {"metric": "l2"}
+    if args.embeddings:
+        debug_print(f"Memory-mapping embeddings from {args.embeddings}.f32...")
+        index = embedding_store.MemmapIndex(args.embeddings)
+        params = {"metric": "l2"}
+        metadata_list = embedding_store.MetadataRows(args.embeddings)
+    else:
+        if args.mode != "lexical":
+            debug_print("Loading Faiss index from working_data/faiss.index...")
+            index, params = index_utils.load_index(nprobe=args.nprobe, ef_search=args.ef_search)
+            debug_print("Index params:", params)
+        debug_print("Opening metadata from working_data/faiss_metadata.sqlite...")
+        metadata_list = metadata_store.open_metadata()
 
     # 3) Query index for top-k docs
-    results = query_faiss_index(query_emb, args.top_k, metadata_list, index)
-    debug_print("Top-k results from Faiss:")
+    if args.mode == "vector":
+        query_emb = index_utils.normalize(query_emb[None, :], params["metric"])[0]
+        results = query_faiss_index(query_emb, args.top_k, metadata_list, index)
+    else:
+        debug_print(f"Opening BM25 index from {lexical_index.LEXICAL_PATH}...")
+        lexical = lexical_index.LexicalIndex()
+        if query_emb is not None:
+            query_emb = index_utils.normalize(query_emb[None, :], params["metric"])
+        results = lexical_index.retrieve(args.mode, [args.query], query_emb, index, metadata_list, lexical, args.top_k)[0]
+    debug_print(f"Top-k results ({args.mode}):")
     for r in results:
         debug_print(r)
+    results, context_stats = build_context(results, args.context_tokens, args.cutoff, params["metric"])
+    debug_print("Context:", context_stats)
+
+    cache = None
+    doc_ids = [r["id"] for r in results]
+    if args.answer_cache:
+        # Answers are kept per index or store; a rebuild or update invalidates that one's
+        source_path = args.embeddings + ".json" if args.embeddings else index_utils.INDEX_PATH
+        cache = answer_cache.AnswerCache(args.answer_cache_file, args.answer_cache_ttl,
+                                         args.answer_cache_entries, args.answer_cache_similarity,
+                                         source=os.path.abspath(source_path))
+        cache.check_fingerprint(index_utils.file_signature(source_path))
+        answer, match = cache.get(args.model, doc_ids, args.query, question_vector)
+        if answer is not None:
+            debug_print(f"Answer cache hit ({match}) after {time.monotonic() - started:.3f}s")
+            print("\n=== Final LLM Answer ===")
+            print(answer)
+            return
 
     # 4) Send everything to /api/chat
+    if args.stream:
+        print("\n=== Final LLM Answer ===")
+        retrieved = time.monotonic()
+
+        def print_token(text):
+            print(text, end="", flush=True)
+
+        resp = stream_chat_with_context(args.model, args.query, results, print_token)
+        print()
+        report_prompt_eval(resp)
+        debug_print(
+            f"Time to first token: {retrieved - started + resp['time_to_first_token']:.3f}s "
+            f"({retrieved - started:.3f}s retrieval + {resp['time_to_first_token']:.3f}s chat), "
+            f"{resp['tokens_per_second']:.1f} tokens/sec, total {time.monotonic() - started:.3f}s"
+        )
+        if cache:
+            cache.put(args.model, doc_ids, args.query, resp["message"]["content"], question_vector)
+        return
+
     #answer = chat_with_context(args.model, args.query, results) (debug - show all)
-    answer = chat_with_context(args.model, args.query, results)["message"]["content"]
+    resp = chat_with_context(args.model, args.query, results)
+    report_prompt_eval(resp)
+    answer = resp["message"]["content"]
+    if cache:
+        cache.put(args.model, doc_ids, args.query, answer, question_vector)
 
 
     # 5) Print the final LLM answer
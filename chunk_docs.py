@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import re
+import sys
+
+DEFAULT_SIZE = {"chars": 1000, "tokens": 256}
+DEFAULT_OVERLAP = {"chars": 200, "tokens": 32}
+
+# Rough tokens: words and single punctuation marks
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]*(?=\s|$)")
+SENTENCE_END_TOKENS = {".", "!", "?"}
+
+def char_windows(text, size, overlap):
+    """
+    (start, end) character ranges of at most size chars, each starting overlap chars
+    before the previous one ended. A window is ended at the last sentence end in its
+    second half if there is one, else at the last space, and starts at a word.
+    """
+    start = 0
+    n = len(text)
+    while start < n:
+        end = min(start + size, n)
+        if end < n:
+            half = start + size // 2
+            # Look one char past the window so a "." there is only a sentence end if a space follows
+            sentence_ends = [m.end() for m in SENTENCE_END_RE.finditer(text, half, min(end + 1, n)) if m.end() <= end]
+            if sentence_ends:
+                end = sentence_ends[-1]
+            else:
+                space = text.rfind(" ", half, end)
+                if space != -1:
+                    end = space + 1
+        yield start, end
+        if end >= n:
+            break
+        next_start = max(end - overlap, start + 1)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if 0 <= space < end - 1 else next_start
+
+def token_windows(text, size, overlap):
+    """Like char_windows but counting TOKEN_RE tokens, ending after a sentence-final token when possible."""
+    spans = [(m.start(), m.end(), m.group()) for m in TOKEN_RE.finditer(text)]
+    i = 0
+    while i < len(spans):
+        j = min(i + size, len(spans))
+        if j < len(spans):
+            for k in range(j - 1, i + size // 2 - 1, -1):
+                if spans[k][2] in SENTENCE_END_TOKENS:
+                    j = k + 1
+                    break
+        yield spans[i][0], spans[j - 1][1]
+        if j >= len(spans):
+            break
+        i = max(j - overlap, i + 1)
+
+class ByteOffsets:
+    """Byte offset of a character position in text, for positions asked in increasing order."""
+    def __init__(self, text, base):
+        self.text = text
+        self.ascii = text.isascii()
+        self.base = base
+        self.char = 0
+        self.byte = base
+
+    def at(self, char):
+        if self.ascii:
+            return self.base + char
+        self.byte += len(self.text[self.char:char].encode("utf-8"))
+        self.char = char
+        return self.byte
+
+def chunk_record(doc, windows, first_chunk):
+    """
+    Split one documents.jsonl record into chunk records. start/end are byte offsets
+    into the source file (the flattener only swaps newlines for spaces, so they line
+    up), counted from the record's "offset" when the file was split into parts.
+    """
+    text = doc.get("text", "")
+    base = doc.get("offset", 0)
+    starts, ends = ByteOffsets(text, base), ByteOffsets(text, base)
+    chunk = first_chunk
+    for start, end in windows(text):
+        piece = text[start:end]
+        if not piece.strip():
+            continue
+        yield {
+            "filename": doc["filename"],
+            "chunk": chunk,
+            "start": starts.at(start),
+            "end": ends.at(end),
+            "text": piece
+        }
+        chunk += 1
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Split documents.jsonl records into overlapping chunks for embed_docs.py."
+    )
+    parser.add_argument("--unit", choices=("chars", "tokens"), default="chars",
+                        help="Measure windows in characters or in rough tokens (words and punctuation).")
+    parser.add_argument("--size", type=int, default=None,
+                        help="Window size in --unit (default 1000 chars / 256 tokens).")
+    parser.add_argument("--overlap", type=int, default=None,
+                        help="How much of each window repeats in the next (default 200 chars / 32 tokens).")
+    args = parser.parse_args()
+
+    size = args.size or DEFAULT_SIZE[args.unit]
+    overlap = DEFAULT_OVERLAP[args.unit] if args.overlap is None else args.overlap
+    if not 0 <= overlap < size:
+        parser.error("--overlap must be at least 0 and smaller than --size")
+    split = char_windows if args.unit == "chars" else token_windows
+
+    def windows(text):
+        return split(text, size, overlap)
+
+    docs = chunks = 0
+    last_filename, next_chunk = None, 0
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        doc = json.loads(line)
+        if doc.get("deleted"):
+            print(json.dumps(doc))
+            continue
+        # Parts of one big file arrive in order; keep numbering their chunks on
+        if doc["filename"] != last_filename or not doc.get("chunk"):
+            next_chunk = 0
+        last_filename = doc["filename"]
+        for record in chunk_record(doc, windows, next_chunk):
+            print(json.dumps(record))
+            next_chunk = record["chunk"] + 1
+            chunks += 1
+        docs += 1
+
+    print(f"[DEBUG] {docs} documents -> {chunks} chunks ({args.unit}, size {size}, overlap {overlap})", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
+
+# cat working_data/documents.jsonl | python3 chunk_docs.py > working_data/chunks.jsonl
+# cat working_data/documents.jsonl | python3 chunk_docs.py --unit tokens --size 256 --overlap 32 | python3 embed_docs.py > working_data/embedded_docs.jsonl
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+log = logging.getLogger("embed_cache")
+
+# Failed writes in a row before the writer gives up on the file (the LRU keeps working)
+MAX_WRITE_FAILURES = 3
+
+class EmbedCache:
+    """
+    Content-addressed /api/embed results: sha256(variant + text) -> embedding.
+
+    `variant` is everything in the request besides the input (model, truncate, options,
+    ...) so the same text embedded two different ways is cached twice. The model is the
+    balancer's normalized name, so "qwen" and "qwen:latest" share entries. Lookups go to a
+    bounded in-memory LRU first and then to a sqlite file, so entries survive restarts.
+    Vectors are stored as float64 so the floats written back out are exactly the ones
+    Ollama returned.
+
+    self.lock only ever covers the LRU, never disk I/O. Writes go to the file from one
+    writer thread, so put_many() doesn't block; reads happen in get_stored(), which an
+    event loop should run in an executor. A batch the file rejects is dropped, and after
+    MAX_WRITE_FAILURES in a row nothing more is queued for it.
+    """
+    def __init__(self, path=None, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.lru = OrderedDict()
+
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.writing = False
+        self.write_errors = 0
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            # WAL + NORMAL keeps each put to a page write instead of an fsync
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " digest BLOB PRIMARY KEY, model TEXT, vector BLOB"
+                ") WITHOUT ROWID"
+            )
+            self.db.commit()
+            self.writing = True
+            threading.Thread(target=self._writer, daemon=True).start()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def variant(model, template):
+        """Cache namespace for a request: model plus every other field except input and keep_alive."""
+        fields = {k: v for k, v in template.items() if k not in ("input", "keep_alive")}
+        fields["model"] = model
+        return json.dumps(fields, sort_keys=True)
+
+    @staticmethod
+    def digest(variant, text):
+        return hashlib.sha256(variant.encode("utf-8") + b"\0" + text.encode("utf-8")).digest()
+
+    def get_many(self, variant, texts):
+        """One embedding (list of floats) or None per text. May read the sqlite file."""
+        results, digests = self.get_cached(variant, texts)
+        return self.get_stored(digests, results)
+
+    def get_cached(self, variant, texts):
+        """
+        The in-memory half of get_many(): (results, digests) with None where the LRU
+        has nothing. Never touches the disk.
+        """
+        digests = [self.digest(variant, t) for t in texts]
+        results = [None] * len(texts)
+        with self.lock:
+            for i, d in enumerate(digests):
+                vector = self.lru.get(d)
+                if vector is not None:
+                    self.lru.move_to_end(d)
+                    results[i] = vector
+                    self.hits += 1
+        return results, digests
+
+    def get_stored(self, digests, results):
+        """Fill the gaps get_cached() left from the sqlite file and count what's still missing."""
+        missing = [i for i, r in enumerate(results) if r is None]
+        found = []
+        if missing and self.db is not None:
+            wanted = {}
+            for i in missing:
+                wanted.setdefault(digests[i], []).append(i)
+            keys = list(wanted)
+            with self.db_lock:
+                # Stay under sqlite's bound-parameter limit
+                for start in range(0, len(keys), 500):
+                    batch = keys[start:start + 500]
+                    found.extend(self.db.execute(
+                        f"SELECT digest, vector FROM embeddings WHERE digest IN ({','.join('?' * len(batch))})",
+                        batch
+                    ).fetchall())
+            for d, blob in found:
+                vector = array("d", blob).tolist()
+                for i in wanted[d]:
+                    results[i] = vector
+        with self.lock:
+            for d, blob in found:
+                self._remember(d, results[wanted[d][0]])
+            disk_hits = len(missing) - sum(1 for i in missing if results[i] is None)
+            self.disk_hits += disk_hits
+            self.hits += disk_hits
+            self.misses += len(missing) - disk_hits
+        return results
+
+    def put_many(self, variant, texts, embeddings, model=None):
+        """Store freshly computed embeddings for texts; the file write happens in the background."""
+        rows = []
+        with self.lock:
+            for text, vector in zip(texts, embeddings):
+                d = self.digest(variant, text)
+                self._remember(d, vector)
+                rows.append((d, model, array("d", vector).tobytes()))
+        if self.writing and rows:
+            self.pending.put(rows)
+
+    def _writer(self):
+        """Write queued rows, one commit for whatever has piled up since the last one."""
+        failures = 0
+        while failures < MAX_WRITE_FAILURES:
+            rows = self.pending.get()
+            while True:
+                try:
+                    rows.extend(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.db_lock:
+                    self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+                    self.db.commit()
+                failures = 0
+            except sqlite3.Error as e:
+                failures += 1
+                with self.lock:
+                    self.write_errors += 1
+                log.error("Embed cache write of %d rows failed: %s", len(rows), e)
+                with self.db_lock:
+                    try:
+                        self.db.rollback()
+                    except sqlite3.Error:
+                        pass
+        log.error("Embed cache: %d writes failed in a row, no longer persisting new entries", failures)
+        self.writing = False
+        # Let go of whatever was queued before put_many() saw the flag
+        while True:
+            try:
+                self.pending.get_nowait()
+            except queue.Empty:
+                break
+
+    def _remember(self, digest, vector):
+        """Caller holds self.lock."""
+        self.lru[digest] = vector
+        self.lru.move_to_end(digest)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.lru),
+                "max_entries": self.max_entries,
+                "persistent": self.db is not None,
+                "writing": self.writing,
+                "write_errors": self.write_errors,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -1,24 +1,259 @@
 #!/usr/bin/env python3
-import sys
+import argparse
 import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import requests
 
+from embedding_store import EmbeddingWriter
+from get_models_per_ip import load_server_list
+
 EMBED_URL = "http://localhost:5000/api/embed"
 MODEL_NAME = "qwen:0.5b"
+DEFAULT_BATCH_SIZE = 16
+CHECKPOINT_EVERY_SECONDS = 5.0
+
+_local = threading.local()
+
+def session():
+    """One keep-alive session per worker thread."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+# Failures that can clear up on their own; a 4xx or a malformed reply won't, so those aren't retried
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+def embed_batch(url, model, texts, retries):
+    """Embed a list of texts in one /api/embed call, retrying connection errors, timeouts and 5xx with backoff."""
+    for attempt in range(retries + 1):
+        try:
+            resp = session().post(url, json={"model": model, "input": texts})
+            if 400 <= resp.status_code < 500:
+                raise RuntimeError(f"Embedding server returned {resp.status_code}: {resp.text[:500]}")
+            resp.raise_for_status()
+        except (RETRYABLE_ERRORS + (requests.HTTPError,)) as e:
+            if attempt == retries:
+                raise
+            delay = min(30, 2 ** attempt)
+            print(f"[DEBUG] embed batch failed ({e}), retrying in {delay}s", file=sys.stderr)
+            time.sleep(delay)
+            continue
+        embeddings = resp.json()["embeddings"]
+        if len(embeddings) != len(texts):
+            raise ValueError(f"asked for {len(texts)} embeddings, got {len(embeddings)}")
+        return embeddings
+
+def embed_docs_batch(url, model, docs, retries):
+    """
+    Embeddings for docs, in order. Deletion records ({"filename", "deleted": true})
+    are not embedded; they get None and pass through to the output for build_index.py.
+    """
+    texts = [doc["text"] for doc in docs if not doc.get("deleted")]
+    embeddings = iter(embed_batch(url, model, texts, retries) if texts else [])
+    return [None if doc.get("deleted") else next(embeddings) for doc in docs]
+
+def default_concurrency(servers_file):
+    """One in-flight request per backend slot listed in servers_ip_list."""
+    try:
+        return max(1, sum(slots or 1 for _, slots in load_server_list(servers_file)))
+    except OSError:
+        return 1
+
+class JsonlWriter:
+    """Documents with an "embedding" list added, one JSON object per line; deletion records as they came."""
+    def __init__(self, f, position=None):
+        self.f = f
+        if position:
+            self.truncate(position)
+
+    def write(self, docs, embeddings):
+        for doc, embedding in zip(docs, embeddings):
+            if embedding is not None:
+                doc["embedding"] = embedding
+            self.f.write(json.dumps(doc).encode("utf-8") + b"\n")
+
+    def position(self):
+        return self.f.tell()
+
+    def truncate(self, position):
+        self.f.truncate(position)
+        self.f.seek(position)
+
+    def flush(self):
+        self.f.flush()
 
-for line in sys.stdin:
-    doc = json.loads(line)
-    text = doc["text"]
-    payload = {"model": MODEL_NAME, "input": text}
-    
-    resp = requests.post(EMBED_URL, json=payload)
-    resp.raise_for_status()
-    data = resp.json()
-    
-    doc["embedding"] = data["embeddings"][0]
-    print(json.dumps(doc))
+    def close(self):
+        self.f.close()
 
+class Checkpoint:
+    """
+    Which input lines are already in the output file, saved as JSON next to it.
+
+    `done` is the number of leading input lines written; `extra` lists [start, end)
+    ranges written past that (only with --unordered), and `output_bytes` is where the
+    output ends after them (one offset per file for --format f32). Resuming truncates
+    the output there, so a crash between writing a batch and saving the checkpoint just
+    redoes that batch.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = 0
+        self.extra = []
+        self.output_bytes = 0
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            self.done = state["done"]
+            self.extra = [tuple(r) for r in state["extra"]]
+            self.output_bytes = state["output_bytes"]
+
+    def is_done(self, index):
+        return index < self.done or any(start <= index < end for start, end in self.extra)
+
+    def mark(self, start, end, output_bytes):
+        self.extra.append((start, end))
+        self.extra.sort()
+        while self.extra and self.extra[0][0] <= self.done:
+            self.done = max(self.done, self.extra.pop(0)[1])
+        self.output_bytes = output_bytes
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"done": self.done, "extra": self.extra, "output_bytes": self.output_bytes}, f)
+        os.replace(tmp, self.path)
+
+def read_batches(lines, batch_size, checkpoint):
+    """
+    Yield (start, end, docs) for runs of consecutive input lines that still need
+    embedding, at most batch_size docs each. Blank lines are covered by the range of
+    the batch around them so the checkpoint can step over them.
+    """
+    start, docs = None, []
+    index = -1
+    for index, line in enumerate(lines):
+        if checkpoint.is_done(index):
+            if docs:
+                yield start, index, docs
+            start, docs = None, []
+            continue
+        if start is None:
+            start = index
+        if not line.strip():
+            continue
+        docs.append(json.loads(line))
+        if len(docs) == batch_size:
+            yield start, index + 1, docs
+            start, docs = None, []
+    if docs:
+        yield start, index + 1, docs
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add an \"embedding\" field to each JSONL document from stdin."
+    )
+    parser.add_argument("--url", default=EMBED_URL, help="Embed endpoint (the load balancer).")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Documents sent per /api/embed call.")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="Embed calls in flight at once (0 = one per backend slot in --servers-file).")
+    parser.add_argument("--servers-file", default="servers_ip_list",
+                        help="Backends behind the balancer, used to size --concurrency.")
+    parser.add_argument("--unordered", action="store_true",
+                        help="Write batches as they finish instead of in input order.")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per batch before giving up.")
+    parser.add_argument("--output", default=None,
+                        help="Output file (default stdout); with --format f32, the store prefix.")
+    parser.add_argument("--format", choices=("jsonl", "f32"), default="jsonl",
+                        help="jsonl: documents with an embedding list. f32: raw float32 matrix "
+                             "OUTPUT.f32 plus OUTPUT.meta.jsonl, OUTPUT.meta.idx and OUTPUT.json (see embedding_store.py).")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Resume file; needs --output. Rerun with the same input to pick up where it stopped.")
+    args = parser.parse_args()
+
+    if args.checkpoint and not args.output:
+        parser.error("--checkpoint needs --output")
+    if args.format == "f32" and not args.output:
+        parser.error("--format f32 needs --output")
+    concurrency = args.concurrency or default_concurrency(args.servers_file)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.format == "f32":
+        out = EmbeddingWriter(args.output, checkpoint.output_bytes)
+    elif args.output:
+        out = JsonlWriter(open(args.output, "r+b" if checkpoint.output_bytes else "wb"), checkpoint.output_bytes)
+    else:
+        out = JsonlWriter(sys.stdout.buffer)
+    if checkpoint.done or checkpoint.extra:
+        print(f"[DEBUG] Resuming after {checkpoint.done} input lines", file=sys.stderr)
+
+    written = 0
+    last_save = time.monotonic()
+    next_seq = 0
+    finished = {}
+
+    def write(start, end, docs, embeddings):
+        nonlocal written, last_save
+        out.write(docs, embeddings)
+        written += len(docs)
+        if args.checkpoint:
+            out.flush()
+            checkpoint.mark(start, end, out.position())
+            if time.monotonic() - last_save >= CHECKPOINT_EVERY_SECONDS:
+                checkpoint.save()
+                last_save = time.monotonic()
+
+    def collect(futures):
+        """Wait for at least one batch, then write whatever may be written."""
+        nonlocal next_seq
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            seq, start, end, docs = futures.pop(future)
+            finished[seq] = (start, end, docs, future.result())
+        if args.unordered:
+            for seq in list(finished):
+                write(*finished.pop(seq))
+        else:
+            while next_seq in finished:
+                write(*finished.pop(next_seq))
+                next_seq += 1
+
+    started = time.monotonic()
+    futures = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for seq, (start, end, docs) in enumerate(read_batches(sys.stdin, args.batch_size, checkpoint)):
+                # Bound what's buffered: running batches plus finished ones waiting their turn
+                while len(futures) + len(finished) >= 2 * concurrency:
+                    collect(futures)
+                future = executor.submit(embed_docs_batch, args.url, args.model, docs, args.retries)
+                futures[future] = (seq, start, end, docs)
+            while futures:
+                collect(futures)
+    finally:
+        # Whatever was written so far stays resumable, even if a batch gave up
+        out.flush()
+        checkpoint.save()
+        if args.output:
+            out.close()
+    elapsed = time.monotonic() - started
+    print(f"[DEBUG] Embedded {written} documents in {elapsed:.1f}s "
+          f"({written / elapsed if elapsed else 0:.1f}/s, concurrency {concurrency}, batch {args.batch_size})",
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
 
 # cat documents.jsonl | python embed_docs.py > embedded_docs.jsonl
 # cat working_data/documents.jsonl | python3 embed_docs.py > working_data/embedded_docs.jsonl
-
+# cat working_data/documents.jsonl | python3 embed_docs.py --batch-size 32 --unordered \
+#     --output working_data/embedded_docs.jsonl --checkpoint working_data/embedded_docs.checkpoint
+# cat working_data/documents.jsonl | python3 embed_docs.py --format f32 --output working_data/embedded_docs
@@ -0,0 +1,209 @@
+"""
+Embeddings as a raw float32 matrix instead of JSON float lists.
+
+A store named PREFIX is these files:
+    PREFIX.f32            row-major float32 vectors, no header
+    PREFIX.meta.jsonl     one JSON object per row: the document without its embedding
+    PREFIX.meta.idx       int64 byte offset of each row's line in .meta.jsonl
+    PREFIX.deleted.jsonl  deletion records ({"filename", "deleted": true}), which have no row
+    PREFIX.json           manifest {"dim", "count", "dtype"}
+
+The .f32 file is read back with np.memmap, so building an index or scanning for a
+query never parses or copies the vectors up front, and MetadataRows reads only the
+.meta.jsonl lines of the rows a search returns.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+DTYPE = "float32"
+OFFSET_DTYPE = "<i8"
+SEARCH_CHUNK_ROWS = 65536
+
+def store_paths(prefix):
+    return prefix + ".f32", prefix + ".meta.jsonl", prefix + ".json"
+
+def deleted_path(prefix):
+    return prefix + ".deleted.jsonl"
+
+def offsets_path(prefix):
+    return prefix + ".meta.idx"
+
+class EmbeddingWriter:
+    """
+    Append documents and their embeddings to a store. Documents whose embedding is
+    None are deletion records and go to the .deleted.jsonl file. position()/truncate()
+    let embed_docs.py checkpoint and roll back the files together.
+    """
+    def __init__(self, prefix, position=None):
+        self.prefix = prefix
+        self.vectors_path, self.meta_path, self.manifest_path = store_paths(prefix)
+        self.dim = None
+        self.count = 0
+        resuming = bool(position) and any(position)
+        mode = "wb"
+        if resuming:
+            mode = "r+b"
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r") as f:
+                    self.dim = json.load(f)["dim"]
+        self.vectors = open(self.vectors_path, mode)
+        self.meta = open(self.meta_path, mode)
+        self.deleted = open(deleted_path(prefix), "r+b" if resuming and os.path.exists(deleted_path(prefix)) else "wb")
+        self.offsets = open(offsets_path(prefix), mode)
+        if resuming:
+            self.truncate(position)
+
+    def write(self, docs, embeddings):
+        for doc, embedding in zip(docs, embeddings):
+            if embedding is None:
+                self.deleted.write(json.dumps(doc).encode("utf-8") + b"\n")
+        rows = [(doc, embedding) for doc, embedding in zip(docs, embeddings) if embedding is not None]
+        if not rows:
+            return
+        docs = [doc for doc, _ in rows]
+        matrix = np.asarray([embedding for _, embedding in rows], dtype=DTYPE)
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"embedding dimension {matrix.shape[1]} does not match store dimension {self.dim}")
+        self.vectors.write(matrix.tobytes())
+        offsets = []
+        for doc in docs:
+            meta = {k: v for k, v in doc.items() if k != "embedding"}
+            offsets.append(self.meta.tell())
+            self.meta.write(json.dumps(meta).encode("utf-8") + b"\n")
+        self.offsets.write(np.asarray(offsets, dtype=OFFSET_DTYPE).tobytes())
+        self.count += len(docs)
+
+    def position(self):
+        return [self.vectors.tell(), self.meta.tell(), self.deleted.tell()]
+
+    def truncate(self, position):
+        vectors_bytes, meta_bytes, deleted_bytes = (list(position) + [0])[:3]
+        for f, size in ((self.vectors, vectors_bytes), (self.meta, meta_bytes), (self.deleted, deleted_bytes)):
+            f.truncate(size)
+            f.seek(size)
+        self.count = vectors_bytes // (self.dim * 4) if self.dim else 0
+        # One offset per row, so the vectors' position covers this file too
+        self.offsets.truncate(self.count * 8)
+        self.offsets.seek(self.count * 8)
+
+    def flush(self):
+        self.vectors.flush()
+        self.meta.flush()
+        self.deleted.flush()
+        self.offsets.flush()
+        if self.dim is not None:
+            tmp = self.manifest_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"dim": self.dim, "count": self.count, "dtype": DTYPE}, f)
+            os.replace(tmp, self.manifest_path)
+
+    def close(self):
+        self.flush()
+        self.vectors.close()
+        self.meta.close()
+        self.deleted.close()
+        self.offsets.close()
+
+def open_vectors(prefix):
+    """The store's vectors as a read-only (count, dim) float32 memmap."""
+    vectors_path, _, manifest_path = store_paths(prefix)
+    if not os.path.exists(manifest_path):
+        # Nothing but deletion records was written
+        return np.zeros((0, 0), dtype=DTYPE)
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest["count"] == 0:
+        return np.zeros((0, manifest["dim"]), dtype=DTYPE)
+    return np.memmap(vectors_path, dtype=manifest["dtype"], mode="r",
+                     shape=(manifest["count"], manifest["dim"]))
+
+def iter_metadata(prefix):
+    """The store's metadata records, in row order."""
+    _, meta_path, _ = store_paths(prefix)
+    with open(meta_path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+class MetadataRows:
+    """
+    Metadata records looked up by row number through the .meta.idx offsets, usable
+    where query_index.py and chat_with_knowledge.py expect the metadata store.
+    """
+    def __init__(self, prefix):
+        _, meta_path, _ = store_paths(prefix)
+        self.offsets = np.fromfile(offsets_path(prefix), dtype=OFFSET_DTYPE)
+        self.meta = open(meta_path, "rb")
+        # Batch mode in query_index.py searches from several threads
+        self.lock = threading.Lock()
+
+    def get(self, row):
+        if row < 0 or row >= len(self.offsets):
+            return None
+        with self.lock:
+            self.meta.seek(int(self.offsets[row]))
+            line = self.meta.readline()
+        return json.loads(line)
+
+    def get_many(self, ids):
+        return [self.get(row) for row in ids]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.meta.close()
+
+def iter_deleted(prefix):
+    """Filenames the store records as deleted."""
+    if not os.path.exists(deleted_path(prefix)):
+        return
+    with open(deleted_path(prefix), "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)["filename"]
+
+def search(vectors, queries, top_k, chunk_rows=SEARCH_CHUNK_ROWS):
+    """
+    Exact L2 top-k over a (memmapped) matrix, chunk_rows at a time so only one chunk
+    is paged in and scored at once. Returns (distances, indices) shaped like
+    faiss's index.search(): squared L2, -1 where there are fewer than top_k rows.
+    """
+    queries = np.asarray(queries, dtype=DTYPE)
+    nq = len(queries)
+    best_d = np.full((nq, top_k), np.inf, dtype=DTYPE)
+    best_i = np.full((nq, top_k), -1, dtype=np.int64)
+    q_norms = (queries ** 2).sum(axis=1)[:, None]
+
+    for start in range(0, len(vectors), chunk_rows):
+        chunk = np.asarray(vectors[start:start + chunk_rows])
+        d = q_norms - 2 * queries @ chunk.T + (chunk ** 2).sum(axis=1)[None, :]
+        np.maximum(d, 0, out=d)
+        ids = np.broadcast_to(np.arange(start, start + len(chunk)), d.shape)
+
+        all_d = np.concatenate([best_d, d], axis=1)
+        all_i = np.concatenate([best_i, ids], axis=1)
+        keep = np.argpartition(all_d, top_k - 1, axis=1)[:, :top_k]
+        best_d = np.take_along_axis(all_d, keep, axis=1)
+        best_i = np.take_along_axis(all_i, keep, axis=1)
+
+    order = np.argsort(best_d, axis=1, kind="stable")
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    best_i = np.take_along_axis(best_i, order, axis=1)
+
+    best_d[best_i == -1] = np.finfo(DTYPE).max
+    return best_d, best_i
+
+class MemmapIndex:
+    """A store searched exactly with search(), usable where a faiss index is expected."""
+    def __init__(self, prefix):
+        self.vectors = open_vectors(prefix)
+        self.ntotal, self.d = self.vectors.shape
+
+    def search(self, queries, top_k):
+        return search(self.vectors, queries, top_k)
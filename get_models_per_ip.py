@@ -4,6 +4,20 @@ import json
 import requests
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+def load_server_list(path):
+    """
+    Read servers_ip_list: one backend per line as "ip" or "ip slots". Blank lines and
+    lines starting with # are skipped.
+    """
+    servers = []
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            servers.append((parts[0], int(parts[1]) if len(parts) > 1 else None))
+    return servers
+
 def get_models_from_server(ip):
     """Make API request to a single server and return results"""
     url = f"http://{ip}:11434/api/tags"
@@ -22,6 +36,24 @@ def get_models_from_server(ip):
             "error": str(e)
         }
 
+def get_running_models_from_server(ip):
+    """Ask a single server which models are loaded in memory right now (/api/ps)"""
+    url = f"http://{ip}:11434/api/ps"
+    try:
+        response = requests.get(url, timeout=10)
+        response.raise_for_status()
+        return {
+            "ip": ip,
+            "status": "success",
+            "data": response.json()
+        }
+    except requests.exceptions.RequestException as e:
+        return {
+            "ip": ip,
+            "status": "error",
+            "error": str(e)
+        }
+
 def filter_model_data(data):
     """Extract only model names and sizes from the data"""
     models = data.get('models', [])
@@ -0,0 +1,173 @@
+"""
+Index types for build_index.py and the settings the query tools need to search them.
+
+build_index.py saves the settings next to the index (faiss_index_params.json) so
+query_index.py and chat_with_knowledge.py pick up the metric and the nprobe/efSearch
+defaults without being told again.
+
+Vectors are stored under stable document IDs (doc_id()) rather than row numbers, and
+the metadata store (metadata_store.py) maps those IDs to their documents, so single
+documents can be replaced or removed without a rebuild.
+"""
+import hashlib
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+METRICS = ("l2", "cosine")
+
+INDEX_PATH = os.path.join("working_data", "faiss.index")
+PARAMS_PATH = os.path.join("working_data", "faiss_index_params.json")
+
+DEFAULT_HNSW_M = 32
+DEFAULT_EF_CONSTRUCTION = 40
+DEFAULT_EF_SEARCH = 64
+DEFAULT_NPROBE = 16
+DEFAULT_PQ_BITS = 8
+
+def doc_id(filename, chunk=0):
+    """Stable 63-bit ID for one chunk of one file (faiss IDs are signed 64-bit)."""
+    digest = hashlib.sha256(f"{filename}\0{chunk}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+def metadata_for(metadata, idx):
+    """
+    The document for a search result, or None for a -1 (empty) slot. Handles the
+    metadata store as well as the ID-keyed dict and positional list older builds wrote.
+    """
+    if idx < 0:
+        return None
+    if isinstance(metadata, list):
+        return metadata[idx] if idx < len(metadata) else None
+    return metadata.get(str(idx))
+
+def metadata_for_many(metadata, ids):
+    """metadata_for() for a row of search results, in one store lookup."""
+    if hasattr(metadata, "get_many"):
+        return metadata.get_many(ids)
+    return [metadata_for(metadata, idx) for idx in ids]
+
+def auto_nlist(n):
+    """About 4*sqrt(n) lists, with enough points per list to train on."""
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+def auto_pq_m(d):
+    """Largest sub-quantizer count up to 64 that divides d."""
+    return max(m for m in range(1, min(d, 64) + 1) if d % m == 0)
+
+def factory_string(index_type, d, nlist=0, hnsw_m=DEFAULT_HNSW_M, pq_m=0, pq_bits=DEFAULT_PQ_BITS, n=None):
+    """faiss.index_factory string for one of INDEX_TYPES. nlist=0 sizes it from n."""
+    if index_type in ("ivf", "ivfpq") and not nlist:
+        nlist = auto_nlist(n or 1)
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m}"
+    if index_type == "ivfpq":
+        return f"IVF{nlist},PQ{pq_m or auto_pq_m(d)}x{pq_bits}"
+    raise ValueError(f"unknown index type {index_type!r}")
+
+def make_index(d, factory, metric="l2", ef_construction=DEFAULT_EF_CONSTRUCTION):
+    """
+    A new, empty index that takes add_with_ids(). Cosine is inner product over vectors
+    normalized by normalize().
+    """
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+    index = faiss.index_factory(d, factory, faiss_metric)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efConstruction = ef_construction
+    # IDMap2 also keeps the vectors addressable by ID (reconstruct), not just searchable
+    return faiss.IndexIDMap2(index)
+
+def normalize(vectors, metric):
+    """The vectors as they go into (or are searched against) the index: unit length for cosine."""
+    if metric != "cosine":
+        return vectors
+    vectors = np.array(vectors, dtype=np.float32, copy=True)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def apply_search_params(index, nprobe=None, ef_search=None):
+    """Set nprobe / efSearch where the index has them; others are left alone."""
+    space = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if value is None:
+            continue
+        try:
+            space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+def save_params(params, path=PARAMS_PATH):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(params, f, indent=2)
+    os.replace(tmp, path)
+
+def write_index(index, path=INDEX_PATH):
+    """
+    Write through a temp file and rename, so a reader (retrieval_server.py) sees the
+    old index or the new one, never half of one. Write it after the metadata and
+    params: its change is what triggers a reload.
+    """
+    tmp = path + ".tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, path)
+
+def file_signature(path):
+    """Changes whenever build_index.py replaces the file (new inode, mtime or size)."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+def load_params(path=PARAMS_PATH):
+    """Saved build settings; an index built before they were saved is plain L2."""
+    if not os.path.exists(path):
+        return {"metric": "l2"}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def read_index(index_path, params, mmap=True):
+    """
+    Open the index memory-mapped where faiss can, so loading is quick, RSS stays
+    small and processes share the pages: IVF inverted lists with IO_FLAG_MMAP, flat
+    and HNSW vectors with IO_FLAG_MMAP_IFC. The two can't be combined, so try the
+    one that fits the index type first, and fall back to reading it into memory.
+    """
+    if mmap:
+        mmap_flags = [faiss.IO_FLAG_MMAP]
+        if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            if params.get("index_type") in ("ivf", "ivfpq"):
+                mmap_flags.append(faiss.IO_FLAG_MMAP_IFC)
+            else:
+                mmap_flags.insert(0, faiss.IO_FLAG_MMAP_IFC)
+        for flag in mmap_flags:
+            try:
+                return faiss.read_index(index_path, flag | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                continue
+    return faiss.read_index(index_path)
+
+def load_index(index_path=INDEX_PATH, params_path=PARAMS_PATH, nprobe=None, ef_search=None, mmap=True):
+    """
+    Read an index and its saved settings, with the saved nprobe/efSearch applied
+    unless overridden. Returns (index, params). mmap=False gives an index that can
+    be modified.
+    """
+    params = load_params(params_path)
+    index = read_index(index_path, params, mmap)
+    apply_search_params(
+        index,
+        nprobe if nprobe is not None else params.get("nprobe"),
+        ef_search if ef_search is not None else params.get("efSearch")
+    )
+    return index, params
@@ -0,0 +1,221 @@
+"""
+A BM25 inverted index over the same doc IDs as the Faiss index, in a sqlite file
+(lexical_index.sqlite) next to it. Keyword lookups need no /api/embed call, and
+fuse() merges them with vector hits by reciprocal rank for hybrid retrieval.
+"""
+import itertools
+import math
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from collections import Counter
+
+import numpy as np
+
+import index_utils
+
+LEXICAL_PATH = os.path.join("working_data", "lexical_index.sqlite")
+MODES = ("vector", "lexical", "hybrid")
+
+WORD_RE = re.compile(r"\w+")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# The usual constant for reciprocal rank fusion; damps the weight of the very top ranks
+RRF_K = 60
+# Each retriever's candidates per final hit in hybrid mode
+HYBRID_CANDIDATES = 4
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+class LexicalIndex:
+    """Read-only BM25 search; one connection shared by all threads, like metadata_store.MetadataStore."""
+    def __init__(self, path=LEXICAL_PATH):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No BM25 index at {path}; build_index.py writes one unless given --no-lexical")
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        stats = dict(self.query("SELECT key, value FROM stats"))
+        self.ndocs = int(stats.get("docs", 0))
+        self.avgdl = stats.get("avgdl", 0.0) or 1.0
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def search(self, text, top_k):
+        """The top_k (doc_id, bm25 score) pairs for the words in text, best first."""
+        terms = sorted(set(tokenize(text)))
+        if not terms or top_k <= 0:
+            return []
+        rows = self.query(
+            f"SELECT df, ids, tfs, lens FROM terms WHERE term IN ({','.join('?' * len(terms))})", terms
+        )
+        if not rows:
+            return []
+        all_ids, all_scores = [], []
+        for df, ids, tfs, lens in rows:
+            tf = np.frombuffer(tfs, dtype=np.uint32).astype(np.float64)
+            dl = np.frombuffer(lens, dtype=np.uint32)
+            idf = math.log(1 + (self.ndocs - df + 0.5) / (df + 0.5))
+            all_ids.append(np.frombuffer(ids, dtype=np.int64))
+            all_scores.append(idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / self.avgdl)))
+        doc_ids, where = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(where, weights=np.concatenate(all_scores))
+        top = np.argsort(-scores, kind="stable")[:top_k]
+        return list(zip(doc_ids[top].tolist(), scores[top].tolist()))
+
+    def close(self):
+        self.db.close()
+
+class LexicalWriter:
+    """
+    Builds or updates the index through a temp file that replaces the old one on
+    close(), like metadata_store.MetadataWriter. Each term's postings are stored as
+    one row of packed arrays (doc IDs, term counts, doc lengths; 16 bytes a posting),
+    so a lookup is one row read. New postings are staged in a temp table and merged
+    into those rows once, on close().
+    """
+    def __init__(self, path=LEXICAL_PATH, update=False):
+        self.path = path
+        self.tmp = path + ".tmp"
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+        if update:
+            shutil.copyfile(path, self.tmp)
+        self.db = sqlite3.connect(self.tmp)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS terms (tid INTEGER PRIMARY KEY, term TEXT UNIQUE, df INTEGER, ids BLOB, tfs BLOB, lens BLOB)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, length INTEGER, tids BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value REAL)")
+        self.db.execute("CREATE TEMP TABLE pending (tid INTEGER, id INTEGER, tf INTEGER, length INTEGER)")
+        self.db.execute("CREATE INDEX temp.pending_id ON pending (id)")
+        self.term_ids = dict(self.db.execute("SELECT term, tid FROM terms"))
+        # Terms whose stored postings lose documents, and the documents they lose
+        self.dirty = set()
+        self.removed = set()
+
+    def term_id(self, term):
+        tid = self.term_ids.get(term)
+        if tid is None:
+            tid = self.db.execute("INSERT INTO terms (term, df) VALUES (?, 0)", (term,)).lastrowid
+            self.term_ids[term] = tid
+        return tid
+
+    def write(self, ids, metadata_list):
+        ids = [int(i) for i in ids]
+        # A document written again replaces the earlier copy
+        self.delete([row[0] for row in self.db.execute(
+            f"SELECT id FROM docs WHERE id IN ({','.join('?' * len(ids))})", ids
+        )] if ids else [])
+        postings = []
+        docs = []
+        for doc_id, meta in zip(ids, metadata_list):
+            counts = Counter(tokenize(meta.get("text", "")))
+            length = sum(counts.values())
+            tids = [self.term_id(term) for term in counts]
+            docs.append((doc_id, length, np.array(tids, dtype=np.int32).tobytes()))
+            postings.extend((tid, doc_id, tf, length) for tid, tf in zip(tids, counts.values()))
+        self.db.executemany("INSERT INTO docs VALUES (?, ?, ?)", docs)
+        self.db.executemany("INSERT INTO pending VALUES (?, ?, ?, ?)", postings)
+
+    def delete(self, ids):
+        for doc_id in ids:
+            row = self.db.execute("SELECT tids FROM docs WHERE id = ?", (int(doc_id),)).fetchone()
+            if row is None:
+                continue
+            self.dirty.update(np.frombuffer(row[0], dtype=np.int32).tolist())
+            self.removed.add(int(doc_id))
+            self.db.execute("DELETE FROM docs WHERE id = ?", (int(doc_id),))
+            self.db.execute("DELETE FROM pending WHERE id = ?", (int(doc_id),))
+
+    def merge(self, tid, added, removed):
+        """Rewrite one term's postings: drop removed documents, append added (id, tf, length) rows."""
+        ids, tfs, lens = self.db.execute("SELECT ids, tfs, lens FROM terms WHERE tid = ?", (tid,)).fetchone()
+        ids = np.frombuffer(ids or b"", dtype=np.int64)
+        tfs = np.frombuffer(tfs or b"", dtype=np.uint32)
+        lens = np.frombuffer(lens or b"", dtype=np.uint32)
+        if len(removed):
+            keep = ~np.isin(ids, removed)
+            ids, tfs, lens = ids[keep], tfs[keep], lens[keep]
+        ids = np.concatenate([ids, added[:, 0]])
+        tfs = np.concatenate([tfs, added[:, 1].astype(np.uint32)])
+        lens = np.concatenate([lens, added[:, 2].astype(np.uint32)])
+        if len(ids):
+            self.db.execute("UPDATE terms SET df = ?, ids = ?, tfs = ?, lens = ? WHERE tid = ?",
+                            (len(ids), ids.tobytes(), tfs.tobytes(), lens.tobytes(), tid))
+        else:
+            self.db.execute("DELETE FROM terms WHERE tid = ?", (tid,))
+
+    def close(self):
+        removed = np.array(sorted(self.removed), dtype=np.int64)
+        merged = set()
+        staged = self.db.execute("SELECT tid, id, tf, length FROM pending ORDER BY tid")
+        for tid, rows in itertools.groupby(staged, key=lambda row: row[0]):
+            self.merge(tid, np.array([row[1:] for row in rows], dtype=np.int64), removed)
+            merged.add(tid)
+        for tid in self.dirty - merged:
+            self.merge(tid, np.empty((0, 3), dtype=np.int64), removed)
+
+        ndocs, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        self.db.executemany("INSERT OR REPLACE INTO stats VALUES (?, ?)",
+                            [("docs", ndocs), ("avgdl", total / ndocs if ndocs else 0.0)])
+        self.db.commit()
+        if len(removed):
+            # Rewritten postings leave free pages behind
+            self.db.execute("VACUUM")
+        self.db.close()
+        os.replace(self.tmp, self.path)
+
+def fuse(vector_hits, lexical_hits, top_k, k=RRF_K):
+    """
+    Reciprocal rank fusion of (doc_id, distance) vector hits and (doc_id, score)
+    lexical hits, both best first: each list adds 1 / (k + rank) to a document. Returns
+    up to top_k hit dicts with the fused "score" and whichever of "distance" and
+    "bm25" the document had.
+    """
+    fused = {}
+    for rank, (doc_id, dist) in enumerate(vector_hits, start=1):
+        hit = fused.setdefault(doc_id, {"id": doc_id, "score": 0.0})
+        hit["score"] += 1.0 / (k + rank)
+        hit["distance"] = dist
+    for rank, (doc_id, score) in enumerate(lexical_hits, start=1):
+        hit = fused.setdefault(doc_id, {"id": doc_id, "score": 0.0})
+        hit["score"] += 1.0 / (k + rank)
+        hit["bm25"] = score
+    return sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)[:top_k]
+
+def retrieve(mode, texts, vectors, index, metadata, lexical, top_k):
+    """
+    Hits for each query, best first, as dicts of id, the document's metadata and
+    "distance" (vector), "bm25" (lexical) or both plus the fused "score" (hybrid).
+    vectors must already be normalized for the index's metric; lexical mode doesn't
+    use them or the index, so the caller can skip the embed call and pass None.
+    """
+    candidates = top_k * HYBRID_CANDIDATES if mode == "hybrid" else top_k
+    vector_hits = [[] for _ in texts]
+    if mode != "lexical":
+        distances, indices = index.search(vectors, candidates)
+        vector_hits = [
+            [(idx, dist) for idx, dist in zip(row_i.tolist(), row_d.tolist()) if idx >= 0]
+            for row_d, row_i in zip(distances, indices)
+        ]
+    lexical_hits = [lexical.search(text, candidates) if mode != "vector" else [] for text in texts]
+
+    results = []
+    for vec, lex in zip(vector_hits, lexical_hits):
+        if mode == "vector":
+            hits = [{"id": idx, "distance": dist} for idx, dist in vec]
+        elif mode == "lexical":
+            hits = [{"id": idx, "bm25": score} for idx, score in lex]
+        else:
+            hits = fuse(vec, lex, top_k)
+        metas = index_utils.metadata_for_many(metadata, [hit["id"] for hit in hits])
+        results.append([{**hit, **meta} for hit, meta in zip(hits, metas) if meta is not None])
+    return results
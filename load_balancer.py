@@ -1,40 +1,552 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import logging
 import socket
 import threading
+import time
 import json
+import random
+import re
 import requests
-from typing import Dict
+import requests.adapters
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from embed_cache import EmbedCache
+from get_models_per_ip import get_models_from_server, get_running_models_from_server, load_server_list
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, BalancerMetrics
+
+log = logging.getLogger("load_balancer")
+
+OLLAMA_PORT = 11434
+PROXIED_ENDPOINTS = ("/api/generate", "/api/chat", "/api/embed")
+UPSTREAM_CHUNK_SIZE = 4096
+UPSTREAM_CONNECT_TIMEOUT = 10
+# Seconds an idle client keep-alive connection is held open
+KEEPALIVE_TIMEOUT = 75
+MAX_HEADER_BYTES = 65536
+DEFAULT_MAX_BODY_BYTES = 256 * 1024 * 1024
+DEFAULT_COALESCE_MAX_BATCH = 64
+# Upstream time allowed for a coalesced embed batch, on top of the window and queue
+# timeout, before the requests waiting on it give up with a 502
+COALESCED_BATCH_TIMEOUT = 120.0
+DEFAULT_EMBED_CACHE_ENTRIES = 10000
+ROUTING_STRATEGIES = ("latency", "least_loaded", "p2c", "first")
+LOG_LEVELS = ("debug", "info", "warning", "error")
+# /metrics model label for requests naming a model no server lists
+OTHER_MODEL_LABEL = "other"
+DEFAULT_SERVERS = ("10.0.0.19", "10.0.2.239")
+
+EWMA_ALPHA = 0.2
+# Share of latency-routed requests sent to a random free host instead, so a host
+# that looked slow once keeps getting timed and can win its traffic back
+EXPLORE_PROBABILITY = 0.05
+# Cost assumed for a backend/model pair we have never timed
+DEFAULT_EXPECTED_SECONDS = 1.0
+# How much of each response we keep to find Ollama's final timing fields
+RESPONSE_TAIL_BYTES = 4096
+# Ollama's /api/embed reply fields besides the vectors
+EMBED_TIMING_FIELDS = ("total_duration", "load_duration", "prompt_eval_count")
+_TIMING_FIELD_RE = re.compile(
+    rb'"(total_duration|load_duration|prompt_eval_count|prompt_eval_duration|eval_count|eval_duration)"\s*:\s*(\d+)'
+)
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable"
+}
+
+# Recorded as the status of a request whose client went away mid-response (nginx's code)
+CLIENT_CLOSED_STATUS = 499
+
+class ClientDisconnected(Exception):
+    """Writing the response to the client failed: it hung up, not the backend."""
+
+class HttpError(Exception):
+    """A malformed or oversized client request, answered with status_code before closing."""
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
 
 class ServerInfo:
-    def __init__(self, ip):
+    def __init__(self, ip, max_in_flight=1):
         self.ip = ip
-        self.busy = False
+        # Should match OLLAMA_NUM_PARALLEL on the host
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+        # Filled in by SimpleBalancer.refresh_inventory(). models stays None until the
+        # first successful /api/tags so we don't refuse traffic before we know anything.
+        self.models: Optional[set] = None
+        self.warm_models: set = set()
+        self.healthy = True
+        self.inventory_at = None
+
+    def can_serve(self, model):
+        return self.healthy and (model is None or self.models is None or model in self.models)
+
+    @property
+    def busy(self):
+        return self.in_flight >= self.max_in_flight
+
+    @property
+    def load(self):
+        return self.in_flight / self.max_in_flight
+
+def ewma(old, sample, alpha=EWMA_ALPHA):
+    return sample if old is None else old + alpha * (sample - old)
+
+class LatencyStats:
+    """EWMAs of what one backend (or the whole fleet) has delivered for one model."""
+    def __init__(self):
+        self.ttfb = None            # seconds until the first generated token
+        self.tokens_per_sec = None
+        self.eval_count = None      # tokens generated per response
+        self.samples = 0
+
+    def observe(self, total_seconds, timings):
+        """Fold in one finished response: wall-clock seconds + Ollama's timing fields."""
+        eval_count = timings.get("eval_count")
+        eval_ns = timings.get("eval_duration")
+        if eval_count and eval_ns:
+            self.tokens_per_sec = ewma(self.tokens_per_sec, eval_count / (eval_ns / 1e9))
+            self.eval_count = ewma(self.eval_count, eval_count)
+            # Everything but decoding: network, model load and prompt eval. This is the
+            # time to first byte whether or not the client asked for a stream.
+            first = max(total_seconds - eval_ns / 1e9, 0.0)
+        else:
+            # /api/embed has no decode phase, the whole response is the first byte
+            first = total_seconds
+        self.ttfb = ewma(self.ttfb, first)
+        self.samples += 1
+
+    def expected_seconds(self):
+        """Predicted wall time for the next request, or None before the first sample."""
+        if self.ttfb is None:
+            return None
+        if self.tokens_per_sec and self.eval_count:
+            return self.ttfb + self.eval_count / self.tokens_per_sec
+        return self.ttfb
+
+    def as_dict(self):
+        return {
+            "ttfb": self.ttfb,
+            "tokens_per_sec": self.tokens_per_sec,
+            "eval_count": self.eval_count,
+            "expected_seconds": self.expected_seconds(),
+            "samples": self.samples
+        }
+
+class _Waiter:
+    """A request parked in the balancer queue by a handler thread."""
+    def __init__(self, model, endpoint):
+        self.model = model
+        self.endpoint = endpoint
+        self.sinfo: Optional[ServerInfo] = None
+        self.enqueued_at = time.monotonic()
+        self._event = threading.Event()
+
+    def wake(self, sinfo: ServerInfo):
+        self.sinfo = sinfo
+        self._event.set()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+
+class _AsyncWaiter:
+    """A request parked in the balancer queue by a coroutine on an event loop."""
+    def __init__(self, loop, model, endpoint):
+        self.model = model
+        self.endpoint = endpoint
+        self.sinfo: Optional[ServerInfo] = None
+        self.enqueued_at = time.monotonic()
+        self._loop = loop
+        self._future = loop.create_future()
+
+    def wake(self, sinfo: ServerInfo):
+        # Called with the balancer lock held, possibly from another thread
+        self.sinfo = sinfo
+        self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    async def wait(self, timeout):
+        await asyncio.wait([self._future], timeout=timeout)
 
 class SimpleBalancer:
     """
-    Minimal example: We have 2 servers: 10.0.0.19, 10.0.2.239.
-    We'll pick whichever isn't busy.
+    Servers come from `servers` (see load_server_list), defaulting to 10.0.0.19 and
+    10.0.2.239. Each has max_in_flight request slots.
+
+    A request only goes to healthy servers whose /api/tags inventory lists its model,
+    and among those, to servers that already have the model loaded (/api/ps) if any
+    has a free slot. start_inventory_refresh() keeps both lists current.
+
+    We pick among the remaining servers with a free slot using `strategy`:
+      - latency: soonest expected finish, from EWMAs of each host's time to first byte
+        and tokens/sec for the requested model and endpoint, scaled up by how busy the
+        host is; EXPLORE_PROBABILITY of requests go to a random free host instead, so
+        estimates for hosts we stopped picking don't go stale
+      - least_loaded: lowest in_flight / max_in_flight, ties broken at random
+      - p2c: power of two choices, the less loaded of two random candidates
+      - first: first server in dict order with a free slot (the old behaviour)
+
+    When every usable slot is taken, acquire() parks the request in a bounded FIFO queue
+    and a released slot goes straight to the oldest waiter that server can serve, so
+    bursts drain at full backend capacity instead of bouncing off a 503.
     """
-    def __init__(self):
-        self.servers: Dict[str, ServerInfo] = {
-            "10.0.0.19": ServerInfo("10.0.0.19"),
-            "10.0.2.239": ServerInfo("10.0.2.239")
-        }
+    def __init__(self, max_queue=256, queue_timeout=30.0, max_in_flight=1, strategy="latency",
+                 servers=None):
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.servers: Dict[str, ServerInfo] = {}
+        for entry in servers or DEFAULT_SERVERS:
+            ip, slots = entry if isinstance(entry, tuple) else (entry, None)
+            self.servers[ip] = ServerInfo(ip, slots or max_in_flight)
+        self.strategy = strategy
         self.lock = threading.Lock()
 
-    def pick_server(self):
-        """Pick the first server that isn't busy. Otherwise, return None."""
+        # (ip, model, endpoint) -> LatencyStats, plus a fleet-wide prior per
+        # (model, endpoint) for hosts we haven't timed yet
+        self.latency: Dict[tuple, LatencyStats] = {}
+        self.model_latency: Dict[tuple, LatencyStats] = {}
+
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiters = deque()
+
+        # Queue counters, read through stats()
+        self.queued_total = 0
+        self.queue_rejected = 0
+        self.queue_timeouts = 0
+        self.queue_depth_max = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def pick_server(self, model=None, endpoint=None):
+        """Claim a slot on a server with spare capacity. Otherwise, return None."""
+        with self.lock:
+            return self._take_free_server(model, endpoint)
+
+    def _take_free_server(self, model=None, endpoint=None):
+        """Caller holds self.lock. Claims a slot on the server chosen by self.strategy."""
+        candidates = [
+            sinfo for sinfo in self.servers.values()
+            if not sinfo.busy and sinfo.can_serve(model)
+        ]
+        if not candidates:
+            return None
+
+        # A host that already has the model in memory skips the load_duration cost
+        warm = [c for c in candidates if model in c.warm_models]
+        if warm:
+            candidates = warm
+
+        if self.strategy == "first":
+            sinfo = candidates[0]
+        elif self.strategy == "p2c" and len(candidates) > 2:
+            a, b = random.sample(candidates, 2)
+            sinfo = a if a.load <= b.load else b
+        elif self.strategy == "latency" and len(candidates) > 1 and random.random() < EXPLORE_PROBABILITY:
+            sinfo = random.choice(candidates)
+        elif self.strategy == "latency":
+            # Requests sharing a host's slots also share its GPU, so scale by load
+            costs = [self._expected_seconds(c, model, endpoint) * (1 + c.load) for c in candidates]
+            lowest = min(costs)
+            sinfo = random.choice([c for c, cost in zip(candidates, costs) if cost == lowest])
+        else:
+            lowest = min(c.load for c in candidates)
+            sinfo = random.choice([c for c in candidates if c.load == lowest])
+
+        sinfo.in_flight += 1
+        return sinfo
+
+    def _expected_seconds(self, sinfo, model, endpoint):
+        """Caller holds self.lock."""
+        stats = self.latency.get((sinfo.ip, model, endpoint))
+        expected = stats.expected_seconds() if stats else None
+        if expected is None:
+            fleet = self.model_latency.get((model, endpoint))
+            expected = fleet.expected_seconds() if fleet else None
+        return DEFAULT_EXPECTED_SECONDS if expected is None else expected
+
+    def record_response(self, sinfo: ServerInfo, model, endpoint, total_seconds, tail: bytes):
+        """Update latency EWMAs from a successful response (tail = its last bytes)."""
+        timings = parse_timings(tail)
+        with self.lock:
+            for table, key in (
+                (self.latency, (sinfo.ip, model, endpoint)),
+                (self.model_latency, (model, endpoint))
+            ):
+                if key not in table:
+                    table[key] = LatencyStats()
+                table[key].observe(total_seconds, timings)
+
+    def known_model(self, model):
+        """True only for a model some server lists in its inventory."""
+        with self.lock:
+            return model is not None and any(s.models is not None and model in s.models for s in self.servers.values())
+
+    def model_available(self, model):
+        """False when no healthy server has (or might have) the model in its inventory."""
+        if model is None:
+            return True
+        with self.lock:
+            healthy = [s for s in self.servers.values() if s.healthy]
+            # With the whole fleet down, queue and let a recovering host pick it up
+            return not healthy or any(s.can_serve(model) for s in healthy)
+
+    def refresh_inventory(self):
+        """Re-read /api/tags and /api/ps on every server in parallel."""
+        def fetch(ip):
+            return ip, get_models_from_server(ip), get_running_models_from_server(ip)
+
+        with ThreadPoolExecutor(max_workers=len(self.servers) or 1) as executor:
+            results = list(executor.map(fetch, list(self.servers)))
+
+        with self.lock:
+            for ip, tags, ps in results:
+                sinfo = self.servers[ip]
+                if tags["status"] != "success":
+                    log.error("Inventory refresh failed for %s: %s", ip, tags["error"])
+                    sinfo.healthy = False
+                    continue
+                sinfo.healthy = True
+                sinfo.models = {m["name"] for m in tags["data"].get("models", []) if "name" in m}
+                if ps["status"] == "success":
+                    sinfo.warm_models = {m["name"] for m in ps["data"].get("models", []) if "name" in m}
+                else:
+                    sinfo.warm_models = set()
+                sinfo.inventory_at = time.time()
+            # Newly healthy hosts or newly pulled models may unblock queued requests
+            self._dispatch_waiters()
+
+    def start_inventory_refresh(self, interval=30.0):
+        """Refresh once now, then every `interval` seconds on a daemon thread."""
+        self.refresh_inventory()
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh_inventory()
+                except Exception as e:
+                    log.error("refresh_inventory: %s", e)
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def acquire(self, model=None, endpoint=None, timeout=None):
+        """
+        Blocking pick_server(): wait up to `timeout` seconds (default queue_timeout) for a
+        server. Returns None if the queue is full or the wait timed out.
+        """
+        with self.lock:
+            waiter = self._enqueue(_Waiter(model, endpoint))
+            if not isinstance(waiter, _Waiter):
+                return waiter
+        waiter.wait(self.queue_timeout if timeout is None else timeout)
+        with self.lock:
+            return self._finish_wait(waiter)
+
+    async def acquire_async(self, model=None, endpoint=None, timeout=None):
+        """Event-loop flavour of acquire(); never blocks the loop."""
+        with self.lock:
+            waiter = self._enqueue(_AsyncWaiter(asyncio.get_running_loop(), model, endpoint))
+            if not isinstance(waiter, _AsyncWaiter):
+                return waiter
+        try:
+            await waiter.wait(self.queue_timeout if timeout is None else timeout)
+        except asyncio.CancelledError:
+            # Client went away while parked; give back anything we were handed
+            with self.lock:
+                sinfo = self._finish_wait(waiter)
+            if sinfo:
+                self.release_server(sinfo)
+            raise
         with self.lock:
-            for ip, sinfo in self.servers.items():
-                if not sinfo.busy:
-                    sinfo.busy = True
-                    return sinfo
+            return self._finish_wait(waiter)
+
+    def _enqueue(self, waiter):
+        """
+        Caller holds self.lock. Returns a server if one is free right now, None if the
+        queue is full, otherwise the waiter after parking it.
+
+        Free slots are always handed to a waiter that can use them, so taking one here
+        never overtakes an older request for the same model.
+        """
+        sinfo = self._take_free_server(waiter.model, waiter.endpoint)
+        if sinfo:
+            return sinfo
+        if len(self.waiters) >= self.max_queue:
+            self.queue_rejected += 1
             return None
+        self.waiters.append(waiter)
+        self.queued_total += 1
+        self.queue_depth_max = max(self.queue_depth_max, len(self.waiters))
+        return waiter
+
+    def _finish_wait(self, waiter):
+        """Caller holds self.lock. Returns the server handed to the waiter, or None on timeout."""
+        if waiter.sinfo is None:
+            self.waiters.remove(waiter)
+            self.queue_timeouts += 1
+        waited = time.monotonic() - waiter.enqueued_at
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        return waiter.sinfo
 
     def release_server(self, sinfo: ServerInfo):
-        """Mark server as free."""
+        """Give the slot back and let the oldest waiter that can use it take it."""
+        with self.lock:
+            sinfo.in_flight -= 1
+            self._dispatch_waiters()
+
+    def _dispatch_waiters(self):
+        """Caller holds self.lock. Wake queued requests, oldest first, while slots fit them."""
+        for waiter in list(self.waiters):
+            sinfo = self._take_free_server(waiter.model, waiter.endpoint)
+            if sinfo:
+                self.waiters.remove(waiter)
+                waiter.wake(sinfo)
+
+    def stats(self):
+        """Snapshot of queue and server state for the /stats endpoint."""
+        with self.lock:
+            finished = self.queued_total - len(self.waiters)
+            return {
+                "queue_depth": len(self.waiters),
+                "queue_depth_max": self.queue_depth_max,
+                "max_queue": self.max_queue,
+                "queue_timeout": self.queue_timeout,
+                "queued_total": self.queued_total,
+                "queue_rejected": self.queue_rejected,
+                "queue_timeouts": self.queue_timeouts,
+                "wait_time_avg": self.wait_time_total / finished if finished else 0.0,
+                "wait_time_max": self.wait_time_max,
+                "strategy": self.strategy,
+                "servers": {
+                    ip: {
+                        "in_flight": s.in_flight,
+                        "max_in_flight": s.max_in_flight,
+                        "healthy": s.healthy,
+                        "models": sorted(s.models) if s.models is not None else None,
+                        "warm_models": sorted(s.warm_models),
+                        "latency": {
+                            f"{endpoint} {model}": st.as_dict()
+                            for (sip, model, endpoint), st in self.latency.items() if sip == ip
+                        }
+                    }
+                    for ip, s in self.servers.items()
+                }
+            }
+
+class _EmbedBatch:
+    """Single-input /api/embed requests that will go upstream as one list-input call."""
+    def __init__(self, key, template, event_factory):
+        self.key = key
+        self.template = template
+        self.inputs = []
+        # filled: max_batch reached, send now. done: results holds one (status, body) per input
+        self.filled = event_factory()
+        self.done = event_factory()
+        self.results = None
+        self.closed = False
+
+    def upstream_body(self):
+        return json.dumps({**self.template, "input": self.inputs}).encode("utf-8")
+
+    def finish(self, status_code, body_bytes):
+        """
+        Split the batched upstream response back into one response per input. Each
+        gets the batch's total_duration and load_duration (it waited for all of it) and
+        a share of prompt_eval_count in proportion to its length.
+        """
+        results = None
+        if status_code == 200:
+            try:
+                data = json.loads(body_bytes)
+                embeddings = data["embeddings"]
+                if len(embeddings) == len(self.inputs):
+                    counts = split_count(data.get("prompt_eval_count"), self.inputs)
+                    results = []
+                    for e, count in zip(embeddings, counts):
+                        body = {"model": data.get("model"), "embeddings": [e]}
+                        body.update({k: data[k] for k in ("total_duration", "load_duration") if k in data})
+                        if count is not None:
+                            body["prompt_eval_count"] = count
+                        results.append((200, json.dumps(body).encode("utf-8")))
+                else:
+                    status_code, body_bytes = 500, b'{"error":"Upstream returned the wrong number of embeddings"}'
+            except (ValueError, KeyError, TypeError):
+                status_code, body_bytes = 500, b'{"error":"Unreadable upstream embed response"}'
+        if results is None:
+            results = [(status_code, bytes(body_bytes))] * len(self.inputs)
+        self.results = results
+        self.done.set()
+
+class EmbedCoalescer:
+    """
+    Collects concurrent single-input /api/embed requests that share a model and options
+    for up to `window` seconds (or until max_batch arrive) so they cost one upstream call
+    instead of one each. event_factory is threading.Event or asyncio.Event, matching the
+    server that drives it.
+    """
+    def __init__(self, window, max_batch=DEFAULT_COALESCE_MAX_BATCH, event_factory=threading.Event):
+        self.window = window
+        self.max_batch = max_batch
+        self.event_factory = event_factory
+        self.lock = threading.Lock()
+        self.pending: Dict[str, _EmbedBatch] = {}
+        self.batches = 0
+        self.inputs = 0
+
+    @staticmethod
+    def batch_key(template):
+        """Only requests identical in everything but the input share a batch."""
+        return json.dumps(template, sort_keys=True)
+
+    def add(self, key, template, text):
+        """Join (or open) the pending batch for key. Returns (batch, index, opened)."""
         with self.lock:
-            sinfo.busy = False
+            batch = self.pending.get(key)
+            opened = batch is None
+            if opened:
+                batch = self.pending[key] = _EmbedBatch(key, template, self.event_factory)
+            batch.inputs.append(text)
+            if len(batch.inputs) >= self.max_batch:
+                del self.pending[key]
+                batch.filled.set()
+            return batch, len(batch.inputs) - 1, opened
+
+    def close(self, batch):
+        """Stop batch taking new inputs and count it. Safe to call more than once."""
+        with self.lock:
+            if batch.closed:
+                return
+            batch.closed = True
+            if self.pending.get(batch.key) is batch:
+                del self.pending[batch.key]
+            self.batches += 1
+            self.inputs += len(batch.inputs)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "window": self.window,
+                "max_batch": self.max_batch,
+                "batches": self.batches,
+                "inputs": self.inputs,
+                "avg_batch_size": self.inputs / self.batches if self.batches else 0.0
+            }
 
 class RawHttpServer:
     """
@@ -42,152 +554,1007 @@ class RawHttpServer:
       - POST /api/generate
       - POST /api/chat
       - POST /api/embed
+      - GET /stats (balancer queue/server snapshot as JSON)
+      - GET /metrics (the same plus request counters and latency histograms, in
+        Prometheus text format)
+
+    Then pick a server from the balancer, post to that server's corresponding endpoint
+    through its pooled keep-alive requests.Session, and as data arrives, chunk it to the
+    client. Client connections stay open between requests (the HTTP/1.1 default), and
+    pipelined requests are answered in the order they were sent.
 
-    Then pick a server from the balancer, open a requests.post(stream=True) to that server's
-    corresponding endpoint, and as data arrives, chunk it to the client.
+    With an embed_cache, /api/embed inputs already seen are answered from it and only
+    the misses go upstream. With coalesce_window > 0, single-input /api/embed requests
+    go through an EmbedCoalescer: the thread that opens a batch waits out the window,
+    sends it and hands each waiting thread its own embedding.
     """
-    def __init__(self, balancer: SimpleBalancer, host="0.0.0.0", port=5000):
+    def __init__(self, balancer: SimpleBalancer, host="0.0.0.0", port=5000, backlog=5,
+                 max_body_bytes=DEFAULT_MAX_BODY_BYTES, coalesce_window=0.0,
+                 coalesce_max_batch=DEFAULT_COALESCE_MAX_BATCH, embed_cache: Optional[EmbedCache] = None):
         self.balancer = balancer
+        self.embed_cache = embed_cache
+        self.metrics = BalancerMetrics()
         self.host = host
         self.port = port
+        self.max_body_bytes = max_body_bytes
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = EmbedCoalescer(coalesce_window, coalesce_max_batch, threading.Event)
+        self.sessions: Dict[str, requests.Session] = {}
+        self.sessions_lock = threading.Lock()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"[DEBUG] Server listening on {self.host}:{self.port}")
+        self.server_socket.listen(backlog)
+        log.info("Server listening on %s:%s", self.host, self.port)
 
     def start(self):
         """Accept connections in a loop."""
-        print("[DEBUG] Starting raw HTTP server loop...")
+        log.info("Starting raw HTTP server loop...")
         while True:
             conn, addr = self.server_socket.accept()
             threading.Thread(target=self.handle_connection, args=(conn, addr), daemon=True).start()
 
+    def session_for(self, sinfo: ServerInfo):
+        """One requests.Session per backend, its connection pool sized to the backend's slots."""
+        with self.sessions_lock:
+            session = self.sessions.get(sinfo.ip)
+            if session is None:
+                session = requests.Session()
+                session.mount("http://", requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=sinfo.max_in_flight
+                ))
+                self.sessions[sinfo.ip] = session
+            return session
+
     def handle_connection(self, conn, addr):
-        """Parse the request, route based on path: /api/generate, /api/chat, or /api/embed."""
+        """
+        Serve requests on one client connection until either side closes it. Each request
+        is routed on its path: /api/generate, /api/chat, /api/embed, /stats or /metrics.
+        """
+        conn.settimeout(KEEPALIVE_TIMEOUT)
+        # Small chunk writes on a kept-alive connection otherwise stall on Nagle + delayed ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        rfile = conn.makefile("rb")
         try:
-            request_data = conn.recv(65536)
-            if not request_data:
-                conn.close()
-                return
-
-            request_text = request_data.decode("utf-8", errors="ignore")
-            lines = request_text.split("\r\n")
-            request_line = lines[0] if lines else ""
-            print(f"[DEBUG] Request line from {addr}: {request_line}")
-
-            # Identify path (e.g. "POST /api/generate HTTP/1.1")
-            if not request_line.startswith("POST "):
-                self.send_simple_response(conn, 400, b'{"error":"Invalid Method"}')
-                return
+            keep_alive = True
+            while keep_alive:
+                head = read_request_head(rfile)
+                if head is None:
+                    break
+                method, path, version, headers = head
+                log.debug("Request line from %s: %s %s %s", addr, method, path, version)
 
-            try:
-                method, path, _ = request_line.split(" ", 2)
-            except ValueError:
-                self.send_simple_response(conn, 400, b'{"error":"Invalid Request"}')
-                return
+                # Always consume the body so the next pipelined request starts in the right place
+                keep_alive = wants_keep_alive(version, headers)
+                body_length = request_body_length(headers, self.max_body_bytes)
+                if body_length and "100-continue" in headers.get("expect", "").lower():
+                    conn.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body_bytes = read_request_body(rfile, body_length, self.max_body_bytes)
 
-            # We handle exactly 3 endpoints:
-            if path == "/api/generate":
-                self.handle_request(conn, lines, "/api/generate")
-            elif path == "/api/chat":
-                self.handle_request(conn, lines, "/api/chat")
-            elif path == "/api/embed":
-                self.handle_request(conn, lines, "/api/embed")
-            else:
-                self.send_simple_response(conn, 404, b'{"error":"Not Found"}')
+                if method == "GET" and path == "/stats":
+                    stats_json = json.dumps(self.stats()).encode("utf-8")
+                    self.send_simple_response(conn, 200, stats_json, keep_alive)
+                elif method == "GET" and path == "/metrics":
+                    metrics_text = self.metrics.render(self.stats()).encode("utf-8")
+                    self.send_simple_response(conn, 200, metrics_text, keep_alive, METRICS_CONTENT_TYPE)
+                elif method != "POST":
+                    self.send_simple_response(conn, 400, b'{"error":"Invalid Method"}', keep_alive)
+                elif path in PROXIED_ENDPOINTS:
+                    keep_alive = self.handle_request(conn, body_bytes, path, keep_alive)
+                else:
+                    self.send_simple_response(conn, 404, b'{"error":"Not Found"}', keep_alive)
 
+        except socket.timeout:
+            pass
+        except HttpError as e:
+            err_json = json.dumps({"error": str(e)}).encode("utf-8")
+            self.send_simple_response(conn, e.status_code, err_json)
         except Exception as e:
-            print(f"[ERROR] handle_connection: {e}")
+            log.error("handle_connection: %s", e)
         finally:
+            rfile.close()
             conn.close()
 
-    def handle_request(self, conn, lines, endpoint):
-        """Generic method to handle requests for one of the three endpoints."""
-        # 1) Extract headers + body from lines
+    def handle_request(self, conn, body_bytes, endpoint, keep_alive):
+        """
+        Generic method to handle requests for one of the three endpoints. Returns whether
+        the client connection can carry another request.
+        """
+        started = time.monotonic()
+        req = decode_request(body_bytes)
+        model = request_model(req)
+        status_code = 500
         try:
-            empty_line_idx = lines.index("")
-        except ValueError:
-            empty_line_idx = len(lines)
+            status_code, keep_alive = self.forward_request(conn, body_bytes, req, endpoint, model, keep_alive)
+            return keep_alive
+        finally:
+            # Any name a client sends would otherwise become its own metrics series
+            label = model if self.balancer.known_model(model) else OTHER_MODEL_LABEL
+            self.metrics.request_done(endpoint, label, status_code, time.monotonic() - started)
 
-        headers = {}
-        for hl in lines[1:empty_line_idx]:
-            if ": " in hl:
-                k, v = hl.split(": ", 1)
-                headers[k.lower()] = v
+    def forward_request(self, conn, body_bytes, req, endpoint, model, keep_alive):
+        """handle_request() without the bookkeeping. Returns (status code, keep_alive)."""
+        if not self.balancer.model_available(model):
+            err_json = json.dumps({"error": f"model '{model}' not found on any backend"}).encode("utf-8")
+            self.send_simple_response(conn, 404, err_json, keep_alive)
+            return 404, keep_alive
 
-        content_length = int(headers.get("content-length", 0))
-        body_str = "\r\n".join(lines[empty_line_idx+1:])  # entire request body
+        embed_req = None
+        if endpoint == "/api/embed" and (self.embed_cache or self.coalescer):
+            embed_req = parse_embed_request(req)
+        if embed_req and (self.embed_cache or (self.coalescer and len(embed_req[1]) == 1)):
+            status_code, payload = self.embed(model, *embed_req)
+            self.send_simple_response(conn, status_code, payload, keep_alive)
+            return status_code, keep_alive
 
-        # 2) Pick a server from the balancer
-        sinfo = self.balancer.pick_server()
+        # 1) Pick a server from the balancer, waiting in its queue if all are busy
+        queued = time.monotonic()
+        sinfo = self.balancer.acquire(model, endpoint)
+        self.metrics.queue_wait_seconds.observe(time.monotonic() - queued, endpoint)
         if not sinfo:
-            self.send_simple_response(conn, 503, b'{"error":"No server available"}')
-            return
+            self.send_simple_response(conn, 503, b'{"error":"No server available"}', keep_alive)
+            return 503, keep_alive
 
-        print(f"[DEBUG] Forwarding to {sinfo.ip} for {endpoint}")
+        log.debug("Forwarding to %s for %s", sinfo.ip, endpoint)
 
+        response_started = False
         try:
-            # 3) Forward request in streaming mode
-            backend_url = f"http://{sinfo.ip}:11434{endpoint}"
-            with requests.post(
+            # 2) Forward request in streaming mode over the backend's pooled connections
+            backend_url = f"http://{sinfo.ip}:{OLLAMA_PORT}{endpoint}"
+            started = time.monotonic()
+            ttfb = None
+            nbytes = 0
+            tail = b""
+            with self.session_for(sinfo).post(
                 backend_url,
-                data=body_str.encode("utf-8"),
+                data=body_bytes,
                 headers={"Content-Type": "application/json"},
-                stream=True
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, None)
             ) as resp:
-                
-                # 4) Start chunked response to client
-                status_line = f"HTTP/1.1 {resp.status_code} OK\r\n"
-                conn.sendall(status_line.encode("utf-8"))
-                conn.sendall(b"Content-Type: application/json\r\n")
-                conn.sendall(b"Transfer-Encoding: chunked\r\n")
-                conn.sendall(b"Connection: close\r\n")
-                conn.sendall(b"\r\n")
-
-                # 5) As we read chunks from the model server, forward them to the client
-                for chunk in resp.iter_content(chunk_size=4096):
+
+                # 3) Start chunked response to client
+                send_to_client(conn, (
+                    f"HTTP/1.1 {resp.status_code} {resp.reason}\r\n"
+                    "Content-Type: application/json\r\n"
+                    "Transfer-Encoding: chunked\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                    "\r\n"
+                ).encode("latin-1"))
+                response_started = True
+
+                # 4) As we read chunks from the model server, forward them to the client
+                for chunk in resp.iter_content(chunk_size=UPSTREAM_CHUNK_SIZE):
                     if not chunk:
                         continue
-                    hex_len = f"{len(chunk):X}\r\n".encode("utf-8")
-                    conn.sendall(hex_len)
-                    conn.sendall(chunk)
-                    conn.sendall(b"\r\n")
-                
+                    if ttfb is None:
+                        ttfb = time.monotonic() - started
+                    send_to_client(conn, b"%X\r\n" % len(chunk) + chunk + b"\r\n")
+                    nbytes += len(chunk)
+                    tail = (tail + chunk)[-RESPONSE_TAIL_BYTES:]
+
                 # final zero-length chunk
-                conn.sendall(b"0\r\n\r\n")
+                send_to_client(conn, b"0\r\n\r\n")
+
+                elapsed = time.monotonic() - started
+                self.metrics.upstream_done(sinfo.ip, endpoint, elapsed if ttfb is None else ttfb, elapsed, nbytes)
+                if resp.status_code == 200:
+                    self.balancer.record_response(sinfo, model, endpoint, elapsed, tail)
+            return resp.status_code, keep_alive
 
+        except ClientDisconnected as e:
+            log.debug("Client went away during a response from %s: %s", sinfo.ip, e)
+            self.metrics.client_disconnects.inc(endpoint)
+            return CLIENT_CLOSED_STATUS, False
         except Exception as e:
-            print(f"[ERROR] {e}")
+            log.error("Forwarding to %s failed: %s", sinfo.ip, e)
+            self.metrics.upstream_errors.inc(sinfo.ip, endpoint)
+            # Once the status line is out we can only cut the stream short
+            if response_started:
+                return resp.status_code, False
             err_json = json.dumps({"error": str(e)}).encode("utf-8")
-            self.send_simple_response(conn, 500, err_json)
+            self.send_simple_response(conn, 500, err_json, keep_alive)
+            return 500, keep_alive
         finally:
-            # 6) release server
+            # 5) release server
             self.balancer.release_server(sinfo)
 
-    def send_simple_response(self, conn, status_code, body_bytes):
-        """Send a simple non-chunked response and close."""
-        status_text = {
-            200: "OK",
-            400: "Bad Request",
-            404: "Not Found",
-            500: "Internal Server Error",
-            503: "Service Unavailable"
-        }.get(status_code, "OK")
-
-        headers = [
-            f"HTTP/1.1 {status_code} {status_text}",
-            "Content-Type: application/json; charset=utf-8",
-            f"Content-Length: {len(body_bytes)}",
-            "Connection: close",
-            ""
-        ]
-        response_data = "\r\n".join(headers).encode("utf-8") + body_bytes
-        conn.sendall(response_data)
+    def embed(self, model, template, texts):
+        """
+        Answer an /api/embed request from the cache where possible and fetch the rest,
+        through the coalescer if a single input is left. Returns (status, body).
+        """
+        vectors, missing = cached_embeddings(self.embed_cache, model, template, texts)
+        status_code, payload = 200, b""
+        if missing:
+            miss_texts = [texts[i] for i in missing]
+            if self.coalescer and len(miss_texts) == 1:
+                key = EmbedCoalescer.batch_key(template)
+                status_code, payload = self.coalesce_embed(model, key, template, miss_texts[0])
+            else:
+                body = json.dumps({**template, "input": miss_texts}).encode("utf-8")
+                status_code, payload = self.fetch_embed(model, body)
+        return complete_embeddings(self.embed_cache, model, template, texts, vectors, missing, status_code, payload)
+
+    def coalesce_embed(self, model, key, template, text):
+        """Add one input to a batch; the thread that opened it runs it. Returns (status, body)."""
+        batch, index, opened = self.coalescer.add(key, template, text)
+        if opened:
+            status_code, body_bytes = 500, b'{"error":"Embed batch failed"}'
+            try:
+                batch.filled.wait(self.coalescer.window)
+                self.coalescer.close(batch)
+                status_code, body_bytes = self.fetch_embed(model, batch.upstream_body())
+            finally:
+                # Whatever happened, release the requests waiting on this batch
+                self.coalescer.close(batch)
+                batch.finish(status_code, body_bytes)
+        elif not batch.done.wait(coalesced_wait_timeout(self.coalescer, self.balancer)):
+            return 502, b'{"error":"Coalesced embed batch did not complete"}'
+        return batch.results[index]
+
+    def fetch_embed(self, model, body_bytes):
+        """One buffered /api/embed call on a balancer-chosen backend. Returns (status, body)."""
+        sinfo = None
+        try:
+            queued = time.monotonic()
+            sinfo = self.balancer.acquire(model, "/api/embed")
+            self.metrics.queue_wait_seconds.observe(time.monotonic() - queued, "/api/embed")
+            if not sinfo:
+                return 503, b'{"error":"No server available"}'
+            try:
+                started = time.monotonic()
+                resp = self.session_for(sinfo).post(
+                    f"http://{sinfo.ip}:{OLLAMA_PORT}/api/embed",
+                    data=body_bytes,
+                    headers={"Content-Type": "application/json"},
+                    timeout=(UPSTREAM_CONNECT_TIMEOUT, None)
+                )
+                elapsed = time.monotonic() - started
+                # Buffered: the first byte is only seen once the whole body is in
+                self.metrics.upstream_done(sinfo.ip, "/api/embed", elapsed, elapsed, len(resp.content))
+                if resp.status_code == 200:
+                    self.balancer.record_response(
+                        sinfo, model, "/api/embed", elapsed, resp.content[-RESPONSE_TAIL_BYTES:]
+                    )
+                return resp.status_code, resp.content
+            finally:
+                self.balancer.release_server(sinfo)
+        except Exception as e:
+            log.error("fetch_embed: %s", e)
+            if sinfo:
+                self.metrics.upstream_errors.inc(sinfo.ip, "/api/embed")
+            return 500, json.dumps({"error": str(e)}).encode("utf-8")
+
+    def stats(self):
+        stats = self.balancer.stats()
+        if self.coalescer:
+            stats["coalescer"] = self.coalescer.stats()
+        if self.embed_cache:
+            stats["embed_cache"] = self.embed_cache.stats()
+        return stats
+
+    def send_simple_response(self, conn, status_code, body_bytes, keep_alive=False, content_type=None):
+        """Send a simple non-chunked response."""
+        conn.sendall(build_simple_response(status_code, body_bytes, keep_alive, content_type))
+
+class UpstreamPool:
+    """
+    Idle keep-alive connections to each backend for AsyncHttpServer. Only touched from
+    the event loop thread, so it needs no lock.
+    """
+    def __init__(self, max_idle_per_host=64):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle: Dict[str, list] = {}
+
+    async def connect(self, ip):
+        """Returns (reader, writer, reused), preferring an idle pooled connection."""
+        idle = self.idle.get(ip)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, OLLAMA_PORT),
+            UPSTREAM_CONNECT_TIMEOUT
+        )
+        return reader, writer, False
+
+    def release(self, ip, reader, writer):
+        """Park a connection whose response was read to the end for the next request."""
+        idle = self.idle.setdefault(ip, [])
+        if len(idle) < self.max_idle_per_host and not writer.is_closing() and not reader.at_eof():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+class AsyncHttpServer:
+    """
+    Same endpoints as RawHttpServer, but every client connection is a coroutine on one
+    asyncio event loop instead of a thread, and the upstream call to the Ollama host is made
+    with non-blocking streams over pooled keep-alive connections. Chunks are relayed to the
+    client as soon as they arrive, so thousands of slow streaming clients only cost a
+    socket each.
+
+    The embed cache and coalescer work as in RawHttpServer, except each coalesced batch
+    is sent by its own task so a client hanging up can't strand the others.
+    """
+    def __init__(self, balancer: SimpleBalancer, host="0.0.0.0", port=5000, backlog=1024,
+                 max_body_bytes=DEFAULT_MAX_BODY_BYTES, coalesce_window=0.0,
+                 coalesce_max_batch=DEFAULT_COALESCE_MAX_BATCH, embed_cache: Optional[EmbedCache] = None):
+        self.balancer = balancer
+        self.embed_cache = embed_cache
+        self.metrics = BalancerMetrics()
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.max_body_bytes = max_body_bytes
+        self.upstream = UpstreamPool()
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = EmbedCoalescer(coalesce_window, coalesce_max_batch, asyncio.Event)
+        self.batch_tasks = set()
+
+    def start(self):
+        """Run the event loop until interrupted."""
+        log.info("Starting asyncio HTTP server loop...")
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            limit=MAX_HEADER_BYTES
+        )
+        log.info("Server listening on %s:%s", self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve requests on one client connection until either side closes it. Each request
+        is routed on its path: /api/generate, /api/chat, /api/embed, /stats or /metrics.
+        """
+        addr = writer.get_extra_info("peername")
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return
+                except asyncio.LimitOverrunError:
+                    raise HttpError(400, "Header Too Large")
+
+                method, path, version, headers = parse_request_head(head)
+                log.debug("Request line from %s: %s %s %s", addr, method, path, version)
+
+                # Always consume the body so the next pipelined request starts in the right place
+                keep_alive = wants_keep_alive(version, headers)
+                body_length = request_body_length(headers, self.max_body_bytes)
+                if body_length and "100-continue" in headers.get("expect", "").lower():
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body = await read_request_body_async(reader, body_length, self.max_body_bytes)
+
+                if method == "GET" and path == "/stats":
+                    stats_json = json.dumps(self.stats()).encode("utf-8")
+                    await self.send_simple_response(writer, 200, stats_json, keep_alive)
+                elif method == "GET" and path == "/metrics":
+                    metrics_text = self.metrics.render(self.stats()).encode("utf-8")
+                    await self.send_simple_response(writer, 200, metrics_text, keep_alive, METRICS_CONTENT_TYPE)
+                elif method != "POST":
+                    await self.send_simple_response(writer, 400, b'{"error":"Invalid Method"}', keep_alive)
+                elif path in PROXIED_ENDPOINTS:
+                    keep_alive = await self.handle_request(writer, body, path, keep_alive)
+                else:
+                    await self.send_simple_response(writer, 404, b'{"error":"Not Found"}', keep_alive)
+
+        except HttpError as e:
+            err_json = json.dumps({"error": str(e)}).encode("utf-8")
+            await self.send_simple_response(writer, e.status_code, err_json)
+        except Exception as e:
+            log.error("handle_connection: %r", e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def handle_request(self, writer, body, endpoint, keep_alive):
+        """
+        Forward one request to a backend and relay the response as it streams back.
+        Returns whether the client connection can carry another request.
+        """
+        started = time.monotonic()
+        req = decode_request(body)
+        model = request_model(req)
+        status_code = 500
+        try:
+            status_code, keep_alive = await self.forward_request(writer, body, req, endpoint, model, keep_alive)
+            return keep_alive
+        finally:
+            # Any name a client sends would otherwise become its own metrics series
+            label = model if self.balancer.known_model(model) else OTHER_MODEL_LABEL
+            self.metrics.request_done(endpoint, label, status_code, time.monotonic() - started)
+
+    async def forward_request(self, writer, body, req, endpoint, model, keep_alive):
+        """handle_request() without the bookkeeping. Returns (status code, keep_alive)."""
+        if not self.balancer.model_available(model):
+            err_json = json.dumps({"error": f"model '{model}' not found on any backend"}).encode("utf-8")
+            await self.send_simple_response(writer, 404, err_json, keep_alive)
+            return 404, keep_alive
+
+        embed_req = None
+        if endpoint == "/api/embed" and (self.embed_cache or self.coalescer):
+            embed_req = parse_embed_request(req)
+        if embed_req and (self.embed_cache or (self.coalescer and len(embed_req[1]) == 1)):
+            status_code, payload = await self.embed(model, *embed_req)
+            await self.send_simple_response(writer, status_code, payload, keep_alive)
+            return status_code, keep_alive
+
+        queued = time.monotonic()
+        sinfo = await self.balancer.acquire_async(model, endpoint)
+        self.metrics.queue_wait_seconds.observe(time.monotonic() - queued, endpoint)
+        if not sinfo:
+            await self.send_simple_response(writer, 503, b'{"error":"No server available"}', keep_alive)
+            return 503, keep_alive
+
+        log.debug("Forwarding to %s for %s", sinfo.ip, endpoint)
+
+        response_started = False
+        up_writer = None
+        started = time.monotonic()
+        ttfb = None
+        nbytes = 0
+        tail = b""
+        try:
+            up_reader, up_writer, status_code, reason, resp_headers = await self.open_upstream(
+                sinfo, endpoint, body
+            )
+
+            writer.write((
+                f"HTTP/1.1 {status_code} {reason}\r\n"
+                "Content-Type: application/json\r\n"
+                "Transfer-Encoding: chunked\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                "\r\n"
+            ).encode("latin-1"))
+            response_started = True
+
+            async for chunk in iter_response_body(up_reader, resp_headers):
+                if ttfb is None:
+                    ttfb = time.monotonic() - started
+                writer.write(b"%X\r\n" % len(chunk) + chunk + b"\r\n")
+                await drain_to_client(writer)
+                nbytes += len(chunk)
+                tail = (tail + chunk)[-RESPONSE_TAIL_BYTES:]
+
+            writer.write(b"0\r\n\r\n")
+            await drain_to_client(writer)
+
+            elapsed = time.monotonic() - started
+            self.metrics.upstream_done(sinfo.ip, endpoint, elapsed if ttfb is None else ttfb, elapsed, nbytes)
+            if status_code == 200:
+                self.balancer.record_response(sinfo, model, endpoint, elapsed, tail)
+
+            if response_is_reusable(resp_headers):
+                self.upstream.release(sinfo.ip, up_reader, up_writer)
+                up_writer = None
+            return status_code, keep_alive
+
+        except ClientDisconnected as e:
+            log.debug("Client went away during a response from %s: %r", sinfo.ip, e)
+            self.metrics.client_disconnects.inc(endpoint)
+            return CLIENT_CLOSED_STATUS, False
+        except Exception as e:
+            log.error("Forwarding to %s failed: %r", sinfo.ip, e)
+            self.metrics.upstream_errors.inc(sinfo.ip, endpoint)
+            # Once the status line is out we can only cut the stream short
+            if response_started:
+                return status_code, False
+            err_json = json.dumps({"error": str(e)}).encode("utf-8")
+            await self.send_simple_response(writer, 500, err_json, keep_alive)
+            return 500, keep_alive
+        finally:
+            if up_writer is not None:
+                up_writer.close()
+            self.balancer.release_server(sinfo)
+
+    async def open_upstream(self, sinfo: ServerInfo, endpoint, body):
+        """
+        Send a request over a pooled connection and read the response head.
+        Returns (up_reader, up_writer, status_code, reason, headers).
+        """
+        request_head = (
+            f"POST {endpoint} HTTP/1.1\r\n"
+            f"Host: {sinfo.ip}:{OLLAMA_PORT}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n"
+        ).encode("latin-1")
+
+        while True:
+            up_reader, up_writer, reused = await self.upstream.connect(sinfo.ip)
+            try:
+                # Two writes rather than head + body, which would copy the whole body
+                up_writer.write(request_head)
+                up_writer.write(body)
+                await up_writer.drain()
+                status_code, reason, resp_headers = await read_response_head(up_reader)
+                return up_reader, up_writer, status_code, reason, resp_headers
+            except (ConnectionError, asyncio.IncompleteReadError):
+                up_writer.close()
+                # The backend closed an idle pooled connection under us; try another
+                if not reused:
+                    raise
+            except BaseException:
+                up_writer.close()
+                raise
+
+    async def fetch_upstream(self, sinfo: ServerInfo, endpoint, body):
+        """Non-streaming upstream call. Returns (status_code, body_bytes)."""
+        up_reader, up_writer, status_code, reason, resp_headers = await self.open_upstream(
+            sinfo, endpoint, body
+        )
+        try:
+            chunks = [chunk async for chunk in iter_response_body(up_reader, resp_headers)]
+        except BaseException:
+            up_writer.close()
+            raise
+        if response_is_reusable(resp_headers):
+            self.upstream.release(sinfo.ip, up_reader, up_writer)
+        else:
+            up_writer.close()
+        return status_code, b"".join(chunks)
+
+    async def cached_embeddings(self, model, template, texts):
+        """
+        cached_embeddings() that keeps only the in-memory LRU on the event loop; the
+        sqlite lookup for what it misses runs in the default executor.
+        """
+        cache = self.embed_cache
+        if cache is None or cache.db is None:
+            return cached_embeddings(cache, model, template, texts)
+        vectors, digests = cache.get_cached(EmbedCache.variant(model, template), texts)
+        if any(v is None for v in vectors):
+            loop = asyncio.get_running_loop()
+            vectors = await loop.run_in_executor(None, cache.get_stored, digests, vectors)
+        return vectors, [i for i, v in enumerate(vectors) if v is None]
+
+    async def embed(self, model, template, texts):
+        """Event-loop flavour of RawHttpServer.embed()."""
+        vectors, missing = await self.cached_embeddings(model, template, texts)
+        status_code, payload = 200, b""
+        if missing:
+            miss_texts = [texts[i] for i in missing]
+            if self.coalescer and len(miss_texts) == 1:
+                key = EmbedCoalescer.batch_key(template)
+                status_code, payload = await self.coalesce_embed(model, key, template, miss_texts[0])
+            else:
+                body = json.dumps({**template, "input": miss_texts}).encode("utf-8")
+                status_code, payload = await self.fetch_embed(model, body)
+        return complete_embeddings(self.embed_cache, model, template, texts, vectors, missing, status_code, payload)
+
+    async def fetch_embed(self, model, body_bytes):
+        """One buffered /api/embed call on a balancer-chosen backend. Returns (status, body)."""
+        sinfo = None
+        try:
+            queued = time.monotonic()
+            sinfo = await self.balancer.acquire_async(model, "/api/embed")
+            self.metrics.queue_wait_seconds.observe(time.monotonic() - queued, "/api/embed")
+            if not sinfo:
+                return 503, b'{"error":"No server available"}'
+            try:
+                started = time.monotonic()
+                status_code, payload = await self.fetch_upstream(sinfo, "/api/embed", body_bytes)
+                elapsed = time.monotonic() - started
+                self.metrics.upstream_done(sinfo.ip, "/api/embed", elapsed, elapsed, len(payload))
+                if status_code == 200:
+                    self.balancer.record_response(
+                        sinfo, model, "/api/embed", elapsed, payload[-RESPONSE_TAIL_BYTES:]
+                    )
+                return status_code, payload
+            finally:
+                self.balancer.release_server(sinfo)
+        except Exception as e:
+            log.error("fetch_embed: %r", e)
+            if sinfo:
+                self.metrics.upstream_errors.inc(sinfo.ip, "/api/embed")
+            return 500, json.dumps({"error": str(e)}).encode("utf-8")
+
+    async def coalesce_embed(self, model, key, template, text):
+        """Add one input to a batch and wait for its share of the result. Returns (status, body)."""
+        batch, index, opened = self.coalescer.add(key, template, text)
+        if opened:
+            task = asyncio.ensure_future(self.run_embed_batch(model, batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+        try:
+            await asyncio.wait_for(batch.done.wait(), coalesced_wait_timeout(self.coalescer, self.balancer))
+        except asyncio.TimeoutError:
+            return 502, b'{"error":"Coalesced embed batch did not complete"}'
+        return batch.results[index]
+
+    async def run_embed_batch(self, model, batch):
+        """Wait out the coalescing window, then send the batch as one list-input call."""
+        status_code, body_bytes = 500, b'{"error":"Embed batch failed"}'
+        try:
+            try:
+                await asyncio.wait_for(batch.filled.wait(), self.coalescer.window)
+            except asyncio.TimeoutError:
+                pass
+            self.coalescer.close(batch)
+            status_code, body_bytes = await self.fetch_embed(model, batch.upstream_body())
+        finally:
+            self.coalescer.close(batch)
+            batch.finish(status_code, body_bytes)
+
+    def stats(self):
+        stats = self.balancer.stats()
+        if self.coalescer:
+            stats["coalescer"] = self.coalescer.stats()
+        if self.embed_cache:
+            stats["embed_cache"] = self.embed_cache.stats()
+        return stats
+
+    async def send_simple_response(self, writer, status_code, body_bytes, keep_alive=False, content_type=None):
+        """Send a simple non-chunked response."""
+        writer.write(build_simple_response(status_code, body_bytes, keep_alive, content_type))
+        await writer.drain()
+
+def send_to_client(conn, data):
+    """conn.sendall(), with a failure reported as ClientDisconnected."""
+    try:
+        conn.sendall(data)
+    except OSError as e:
+        raise ClientDisconnected(repr(e)) from e
+
+async def drain_to_client(writer):
+    """writer.drain(), with a failure reported as ClientDisconnected."""
+    try:
+        await writer.drain()
+    except OSError as e:
+        raise ClientDisconnected(repr(e)) from e
+
+def build_simple_response(status_code, body_bytes, keep_alive=False, content_type=None):
+    """Serialize a complete non-chunked response, JSON unless content_type says otherwise."""
+    headers = [
+        f"HTTP/1.1 {status_code} {STATUS_TEXT.get(status_code, 'OK')}",
+        f"Content-Type: {content_type or 'application/json; charset=utf-8'}",
+        f"Content-Length: {len(body_bytes)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ""
+    ]
+    return ("\r\n".join(headers) + "\r\n").encode("utf-8") + body_bytes
+
+def wants_keep_alive(version, headers):
+    """HTTP/1.1 keeps the connection unless told otherwise; HTTP/1.0 only if asked."""
+    connection = headers.get("connection", "").lower()
+    if version.strip().upper() == "HTTP/1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+def response_is_reusable(headers):
+    """Whether an upstream connection can carry another request after this response."""
+    if "close" in headers.get("connection", "").lower():
+        return False
+    return "chunked" in headers.get("transfer-encoding", "").lower() or "content-length" in headers
+
+def normalize_model_name(name):
+    """Ollama lists "qwen" as "qwen:latest" in /api/tags."""
+    if name and ":" not in name:
+        return name + ":latest"
+    return name
+
+def decode_request(body: bytes):
+    """A JSON object request body as a dict, or None if it isn't one. Decoded once per request."""
+    try:
+        req = json.loads(body)
+    except ValueError:
+        return None
+    return req if isinstance(req, dict) else None
+
+def request_model(req):
+    """The normalized "model" field of a decoded request, or None."""
+    return normalize_model_name(req.get("model")) if req else None
+
+def parse_embed_request(req):
+    """
+    (template, texts) for a decoded /api/embed request whose input is a string or a
+    list of strings, else None. template is the request without its input.
+    """
+    if req is None:
+        return None
+    texts = req.get("input")
+    if isinstance(texts, str):
+        texts = [texts]
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        return None
+    return {k: v for k, v in req.items() if k != "input"}, texts
+
+def coalesced_wait_timeout(coalescer, balancer):
+    """How long a request waits on a batch someone else opened: window, queueing, then the call itself."""
+    return coalescer.window + balancer.queue_timeout + COALESCED_BATCH_TIMEOUT
+
+def cached_embeddings(cache: Optional[EmbedCache], model, template, texts):
+    """(vectors, missing): the cached vector or None for each text, and which to fetch."""
+    if cache is None:
+        return [None] * len(texts), list(range(len(texts)))
+    vectors = cache.get_many(EmbedCache.variant(model, template), texts)
+    return vectors, [i for i, v in enumerate(vectors) if v is None]
+
+def complete_embeddings(cache: Optional[EmbedCache], model, template, texts, vectors, missing, status_code, payload):
+    """
+    Fold the upstream reply for texts[missing] into vectors, cache it, and build the
+    client response. Returns (status, body).
+    """
+    # Ollama's timing fields describe the work done upstream: none when every text was cached
+    timings = {field: 0 for field in EMBED_TIMING_FIELDS}
+    if missing:
+        if status_code != 200:
+            return status_code, payload
+        try:
+            upstream = json.loads(payload)
+            fetched = upstream["embeddings"]
+        except (ValueError, KeyError, TypeError):
+            return 500, b'{"error":"Unreadable upstream embed response"}'
+        if len(fetched) != len(missing):
+            return 500, b'{"error":"Upstream returned the wrong number of embeddings"}'
+        for i, vector in zip(missing, fetched):
+            vectors[i] = vector
+        if cache is not None:
+            cache.put_many(EmbedCache.variant(model, template), [texts[i] for i in missing], fetched, model)
+        timings = {field: upstream[field] for field in EMBED_TIMING_FIELDS if field in upstream}
+    return 200, json.dumps({"model": template.get("model"), "embeddings": vectors, **timings}).encode("utf-8")
+
+def split_count(total, texts):
+    """Share an integer total out over texts in proportion to their lengths (None stays None)."""
+    if not isinstance(total, int):
+        return [None] * len(texts)
+    weights = [len(t) or 1 for t in texts]
+    counts = [total * w // sum(weights) for w in weights]
+    # What flooring left over goes to the largest remainders, so the shares add back up to total
+    by_remainder = sorted(range(len(texts)), key=lambda i: total * weights[i] % sum(weights), reverse=True)
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+def parse_timings(tail: bytes):
+    """Pull Ollama's final timing fields out of the last bytes of a response."""
+    timings = {}
+    # Later matches overwrite earlier ones; the final stream chunk carries the totals
+    for key, value in _TIMING_FIELD_RE.findall(tail):
+        timings[key.decode("ascii")] = int(value)
+    return timings
+
+def parse_request_head(head: bytes):
+    """
+    Split a request line + headers block into (method, path, version, headers).
+    Leading blank lines are skipped (a stray CRLF between pipelined requests).
+    """
+    lines = head.decode("latin-1").lstrip("\r\n").split("\r\n")
+    try:
+        method, path, version = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "Invalid Request")
+    return method, path, version, parse_header_lines(lines[1:])
+
+def read_request_head(rfile):
+    """Read one request head from a buffered socket file. Returns None on a clean EOF."""
+    head = bytearray()
+    while True:
+        line = rfile.readline(MAX_HEADER_BYTES)
+        if not line:
+            if head.strip():
+                raise HttpError(400, "Incomplete Request")
+            return None
+        if not line.endswith(b"\n") or len(head) + len(line) > MAX_HEADER_BYTES:
+            raise HttpError(400, "Header Too Large")
+        if line in (b"\r\n", b"\n"):
+            if head:
+                return parse_request_head(bytes(head))
+            continue
+        head += line
+
+def request_body_length(headers, max_body_bytes):
+    """
+    Body size from the headers: an int for Content-Length, None for a chunked body.
+    Raises HttpError for a bad or oversized Content-Length.
+    """
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        return None
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length")
+    if length < 0:
+        raise HttpError(400, "Invalid Content-Length")
+    if length > max_body_bytes:
+        raise HttpError(413, f"Body larger than {max_body_bytes} bytes")
+    return length
+
+def read_request_body(rfile, length, max_body_bytes):
+    """
+    Read exactly `length` body bytes straight into one preallocated buffer, or decode a
+    chunked body when length is None. The bytes are forwarded upstream untouched.
+    """
+    if length is None:
+        body = bytearray()
+        while True:
+            size = _parse_chunk_size(rfile.readline(MAX_HEADER_BYTES))
+            if size == 0:
+                # Skip optional trailers up to the terminating blank line
+                while rfile.readline(MAX_HEADER_BYTES) not in (b"\r\n", b"\n", b""):
+                    pass
+                return body
+            if len(body) + size > max_body_bytes:
+                raise HttpError(413, f"Body larger than {max_body_bytes} bytes")
+            chunk = rfile.read(size + 2)
+            if len(chunk) != size + 2:
+                raise HttpError(400, "Incomplete Request")
+            body += memoryview(chunk)[:size]
+
+    body = bytearray(length)
+    view = memoryview(body)
+    received = 0
+    while received < length:
+        n = rfile.readinto(view[received:])
+        if not n:
+            raise HttpError(400, "Incomplete Request")
+        received += n
+    return body
+
+async def read_request_body_async(reader, length, max_body_bytes):
+    """Event-loop flavour of read_request_body()."""
+    if length is None:
+        body = bytearray()
+        while True:
+            size = _parse_chunk_size(await reader.readline())
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return body
+            if len(body) + size > max_body_bytes:
+                raise HttpError(413, f"Body larger than {max_body_bytes} bytes")
+            try:
+                chunk = await reader.readexactly(size + 2)
+            except asyncio.IncompleteReadError:
+                raise HttpError(400, "Incomplete Request")
+            body += memoryview(chunk)[:size]
+
+    body = bytearray(length)
+    received = 0
+    while received < length:
+        data = await reader.read(length - received)
+        if not data:
+            raise HttpError(400, "Incomplete Request")
+        body[received:received + len(data)] = data
+        received += len(data)
+    return body
+
+def _parse_chunk_size(size_line: bytes):
+    try:
+        size = int(size_line.split(b";", 1)[0].strip(), 16)
+    except ValueError:
+        raise HttpError(400, "Invalid chunk size")
+    if size < 0:
+        raise HttpError(400, "Invalid chunk size")
+    return size
+
+def parse_header_lines(header_lines):
+    """Turn raw "Name: value" lines into a dict with lower-cased names."""
+    headers = {}
+    for hl in header_lines:
+        if ":" in hl:
+            k, v = hl.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return headers
+
+async def read_response_head(reader):
+    """Read an upstream status line + headers. Returns (status_code, reason, headers)."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    status_code = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else STATUS_TEXT.get(status_code, "OK")
+    return status_code, reason, parse_header_lines(lines[1:])
+
+async def iter_response_body(reader, headers):
+    """Yield the upstream body as it arrives, undoing chunked transfer-encoding if present."""
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                raise ConnectionError("upstream closed mid-chunk")
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # Skip optional trailers up to the terminating blank line
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)
+            yield data
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            data = await reader.read(min(remaining, UPSTREAM_CHUNK_SIZE))
+            if not data:
+                raise ConnectionError("upstream closed before Content-Length was reached")
+            remaining -= len(data)
+            yield data
+    else:
+        while True:
+            data = await reader.read(UPSTREAM_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
 
 def main():
-    balancer = SimpleBalancer()
-    server = RawHttpServer(balancer=balancer, host="127.0.0.1", port=5000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["async", "threaded"], default="async",
+                        help="async: one event loop for all connections. threaded: one thread per connection.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on.")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen() accept backlog.")
+    parser.add_argument("--max-queue", type=int, default=256,
+                        help="Requests allowed to wait for a busy backend before answering 503.")
+    parser.add_argument("--queue-timeout", type=float, default=30.0,
+                        help="Seconds a queued request waits for a backend before answering 503.")
+    parser.add_argument("--slots", type=int, default=1,
+                        help="Concurrent requests per backend (match OLLAMA_NUM_PARALLEL).")
+    parser.add_argument("--strategy", choices=ROUTING_STRATEGIES, default="latency",
+                        help="How to pick among backends with a free slot.")
+    parser.add_argument("--servers-file", default="servers_ip_list",
+                        help='Backend list, one "ip" or "ip slots" per line.')
+    parser.add_argument("--refresh-interval", type=float, default=30.0,
+                        help="Seconds between /api/tags + /api/ps inventory refreshes (0 disables).")
+    parser.add_argument("--max-body-mb", type=float, default=DEFAULT_MAX_BODY_BYTES / (1024 * 1024),
+                        help="Largest request body accepted; bigger ones get a 413.")
+    parser.add_argument("--coalesce-window-ms", type=float, default=0.0,
+                        help="Batch concurrent single-input /api/embed calls for this long (0 disables).")
+    parser.add_argument("--coalesce-max-batch", type=int, default=DEFAULT_COALESCE_MAX_BATCH,
+                        help="Send a coalesced embed batch as soon as it has this many inputs.")
+    parser.add_argument("--embed-cache", action="store_true",
+                        help="Cache /api/embed results by (model, options, input text).")
+    parser.add_argument("--embed-cache-file", default="working_data/embed_cache.sqlite",
+                        help='sqlite file that keeps cached embeddings across restarts ("" for memory only).')
+    parser.add_argument("--embed-cache-entries", type=int, default=DEFAULT_EMBED_CACHE_ENTRIES,
+                        help="Embeddings kept in the in-memory LRU in front of the cache file.")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="info",
+                        help="debug logs every request line and backend choice.")
+    args = parser.parse_args()
+    logging.basicConfig(format="[%(levelname)s] %(message)s")
+    log.setLevel(args.log_level.upper())
+
+    balancer = SimpleBalancer(
+        max_queue=args.max_queue,
+        queue_timeout=args.queue_timeout,
+        max_in_flight=args.slots,
+        strategy=args.strategy,
+        servers=load_server_list(args.servers_file)
+    )
+    if args.refresh_interval > 0:
+        balancer.start_inventory_refresh(args.refresh_interval)
+    server_cls = AsyncHttpServer if args.mode == "async" else RawHttpServer
+    server = server_cls(
+        balancer=balancer,
+        host=args.host,
+        port=args.port,
+        backlog=args.backlog,
+        max_body_bytes=int(args.max_body_mb * 1024 * 1024),
+        coalesce_window=args.coalesce_window_ms / 1000,
+        coalesce_max_batch=args.coalesce_max_batch,
+        embed_cache=EmbedCache(args.embed_cache_file, args.embed_cache_entries) if args.embed_cache else None
+    )
     server.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+"""
+Document metadata by doc ID in a sqlite file (faiss_metadata.sqlite), so a query
+reads only the rows it hit instead of loading every document's text up front.
+Readers open it read-only; processes on one box share its pages through the OS
+page cache.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+METADATA_PATH = os.path.join("working_data", "faiss_metadata.sqlite")
+LEGACY_METADATA_PATH = os.path.join("working_data", "faiss_metadata.json")
+
+# Stay under sqlite's bound-parameter limit
+LOOKUP_BATCH = 500
+
+class MetadataStore:
+    """
+    Read-only lookups. One connection shared by all threads: it stays on the file it
+    opened even after a rebuild replaces it, so it always matches the index that was
+    loaded with it.
+    """
+    def __init__(self, path=METADATA_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def get(self, doc_id):
+        rows = self.query("SELECT meta FROM docs WHERE id = ?", (int(doc_id),))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_many(self, ids):
+        """Metadata for each id, None where there is none."""
+        wanted = [int(i) for i in ids if i >= 0]
+        found = {}
+        for start in range(0, len(wanted), LOOKUP_BATCH):
+            batch = wanted[start:start + LOOKUP_BATCH]
+            rows = self.query(f"SELECT id, meta FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch)
+            for doc_id, meta in rows:
+                found[doc_id] = json.loads(meta)
+        return [found.get(int(i)) for i in ids]
+
+    def __len__(self):
+        return self.query("SELECT COUNT(*) FROM docs")[0][0]
+
+    def close(self):
+        self.db.close()
+
+class MetadataWriter:
+    """
+    Writes a store through a temp file that replaces the old one on close(), like
+    index_utils.write_index(). With update=True the temp file starts as a copy of the
+    current store, so readers never see a half-applied update.
+    """
+    def __init__(self, path=METADATA_PATH, update=False):
+        self.path = path
+        self.tmp = path + ".tmp"
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+        if update:
+            shutil.copyfile(path, self.tmp)
+        self.db = sqlite3.connect(self.tmp)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, filename TEXT, meta TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS docs_filename ON docs (filename)")
+        self.count = 0
+
+    def write(self, ids, metadata_list):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+            [(int(i), meta.get("filename", ""), json.dumps(meta, ensure_ascii=False)) for i, meta in zip(ids, metadata_list)]
+        )
+        self.count += len(metadata_list)
+
+    def ids_for_file(self, filename):
+        return [row[0] for row in self.db.execute("SELECT id FROM docs WHERE filename = ?", (filename,))]
+
+    def delete(self, ids):
+        self.db.executemany("DELETE FROM docs WHERE id = ?", [(int(i),) for i in ids])
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        os.replace(self.tmp, self.path)
+
+def open_metadata(path=METADATA_PATH, legacy_path=LEGACY_METADATA_PATH):
+    """The sqlite store, or for an index built before it, the loaded faiss_metadata.json."""
+    if os.path.exists(path):
+        return MetadataStore(path)
+    with open(legacy_path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,170 @@
+"""
+Prometheus text-format metrics for load_balancer.py, without the client library:
+counters and histograms updated on the request path, gauges read from the balancer
+when GET /metrics is scraped.
+"""
+import bisect
+import threading
+
+# Seconds: from cached embeds (milliseconds) to long generations (minutes)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for le, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    labels = format_labels(self.labels, label_values, f'le="{format_value(le)}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def render_samples(name, help_text, kind, labels, samples):
+    """A gauge or counter read at scrape time: samples is a list of (label values, value)."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for label_values, value in samples:
+        if value is not None:
+            lines.append(f"{name}{format_labels(labels, label_values)} {format_value(value)}")
+    return lines
+
+class BalancerMetrics:
+    """What the balancer's request path records, and render() for the /metrics endpoint."""
+    def __init__(self):
+        self.requests = Counter(
+            "ollama_lb_requests_total", "Requests answered, by endpoint, model and status code.",
+            ("endpoint", "model", "status")
+        )
+        self.request_seconds = Histogram(
+            "ollama_lb_request_duration_seconds", "Request time as the client sees it, queueing included.",
+            ("endpoint",)
+        )
+        self.queue_wait_seconds = Histogram(
+            "ollama_lb_queue_wait_seconds", "Time spent waiting for a backend slot.", ("endpoint",)
+        )
+        self.unavailable = Counter(
+            "ollama_lb_unavailable_total", "503 answers: no backend slot within the queue limits.", ("endpoint",)
+        )
+        self.ttfb_seconds = Histogram(
+            "ollama_lb_upstream_ttfb_seconds", "From sending a request to a backend to its first response body byte.",
+            ("backend", "endpoint")
+        )
+        self.upstream_seconds = Histogram(
+            "ollama_lb_upstream_duration_seconds", "From sending a request to a backend to the end of its response.",
+            ("backend", "endpoint")
+        )
+        self.response_bytes = Counter(
+            "ollama_lb_response_bytes_total", "Response body bytes relayed from each backend.", ("backend", "endpoint")
+        )
+        self.upstream_errors = Counter(
+            "ollama_lb_upstream_errors_total", "Backend requests that failed before their response was complete.",
+            ("backend", "endpoint")
+        )
+        self.client_disconnects = Counter(
+            "ollama_lb_client_disconnects_total",
+            "Responses cut short because the client hung up (counted as status 499, not as backend errors).",
+            ("endpoint",)
+        )
+
+    def request_done(self, endpoint, model, status_code, seconds):
+        self.requests.inc(endpoint, model or "", str(status_code))
+        self.request_seconds.observe(seconds, endpoint)
+        if status_code == 503:
+            self.unavailable.inc(endpoint)
+
+    def upstream_done(self, backend, endpoint, ttfb, seconds, nbytes):
+        self.ttfb_seconds.observe(ttfb, backend, endpoint)
+        self.upstream_seconds.observe(seconds, backend, endpoint)
+        self.response_bytes.inc(backend, endpoint, amount=nbytes)
+
+    def render(self, stats):
+        """The exposition text; stats is the server's stats() snapshot for the gauges."""
+        servers = stats["servers"]
+        lines = []
+        lines += render_samples("ollama_lb_backend_in_flight", "Requests running on each backend.", "gauge",
+                                ("backend",), [((ip, ), s["in_flight"]) for ip, s in servers.items()])
+        lines += render_samples("ollama_lb_backend_slots", "Concurrent request slots per backend.", "gauge",
+                                ("backend",), [((ip, ), s["max_in_flight"]) for ip, s in servers.items()])
+        lines += render_samples("ollama_lb_backend_healthy", "1 if the backend answered its last inventory refresh.",
+                                "gauge", ("backend",), [((ip, ), int(s["healthy"])) for ip, s in servers.items()])
+        lines += render_samples("ollama_lb_queue_depth", "Requests waiting for a backend slot.", "gauge",
+                                (), [((), stats["queue_depth"])])
+        lines += render_samples("ollama_lb_queued_total", "Requests that had to wait for a slot.", "counter",
+                                (), [((), stats["queued_total"])])
+        lines += render_samples("ollama_lb_queue_rejected_total", "Requests turned away because the queue was full.",
+                                "counter", (), [((), stats["queue_rejected"])])
+        lines += render_samples("ollama_lb_queue_timeouts_total", "Requests that waited longer than the queue timeout.",
+                                "counter", (), [((), stats["queue_timeouts"])])
+        cache = stats.get("embed_cache")
+        if cache:
+            lines += render_samples("ollama_lb_embed_cache_hits_total", "Embed inputs answered from the cache.",
+                                    "counter", (), [((), cache["hits"])])
+            lines += render_samples("ollama_lb_embed_cache_misses_total", "Embed inputs sent upstream.",
+                                    "counter", (), [((), cache["misses"])])
+        coalescer = stats.get("coalescer")
+        if coalescer:
+            lines += render_samples("ollama_lb_coalesced_batches_total", "Coalesced /api/embed batches sent.",
+                                    "counter", (), [((), coalescer["batches"])])
+            lines += render_samples("ollama_lb_coalesced_inputs_total", "Inputs sent in coalesced batches.",
+                                    "counter", (), [((), coalescer["inputs"])])
+        for metric in (self.requests, self.request_seconds, self.queue_wait_seconds, self.unavailable,
+                       self.ttfb_seconds, self.upstream_seconds, self.response_bytes, self.upstream_errors,
+                       self.client_disconnects):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
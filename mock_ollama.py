@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+A stand-in for an Ollama host, for benchmarking load_balancer.py without GPUs. It
+answers /api/tags, /api/ps, /api/generate, /api/chat and /api/embed with Ollama's
+response shapes (NDJSON streaming, final chunk with timing fields) and a latency
+model set on the command line: a fixed delay before the first token, prompt tokens
+at --prompt-rate, generated tokens at --token-rate, and at most --parallel requests
+running at once, the rest waiting as they would for a GPU.
+
+The balancer always talks to port 11434, so to emulate a fleet on one box give
+--hosts several loopback addresses and list them in a servers file.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OLLAMA_PORT = 11434
+CHARS_PER_TOKEN = 4
+WORDS = ("the", "model", "answer", "is", "fish", "frank", "caught", "five", "blue", "red", "and", "a")
+
+def count_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def prompt_text(endpoint, req):
+    if endpoint == "/api/chat":
+        return " ".join(str(m.get("content", "")) for m in req.get("messages", []))
+    return str(req.get("prompt", ""))
+
+def fake_embedding(text, dim):
+    """A unit vector that depends only on the text, so repeated inputs embed identically."""
+    values = []
+    counter = 0
+    while len(values) < dim:
+        digest = hashlib.sha256(f"{counter}\0{text}".encode("utf-8")).digest()
+        values.extend(x / 2 ** 31 - 1.0 for x in struct.unpack("<8I", digest))
+        counter += 1
+    values = values[:dim]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+class MockBackend:
+    """One emulated host's latency model and request slots."""
+    def __init__(self, args, seed):
+        self.models = args.models
+        self.latency = args.latency
+        self.jitter = args.jitter
+        self.prompt_rate = args.prompt_rate
+        self.token_rate = args.token_rate
+        self.tokens = args.tokens
+        self.embed_dim = args.embed_dim
+        self.embed_rate = args.embed_rate
+        self.error_rate = args.error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.slots = threading.Semaphore(args.parallel) if args.parallel > 0 else None
+
+    def delay(self):
+        """The fixed part of a request's latency (model load, scheduling), with jitter."""
+        with self.random_lock:
+            return self.latency * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self):
+        with self.random_lock:
+            return self.random.random() < self.error_rate
+
+    def acquire(self):
+        if self.slots:
+            self.slots.acquire()
+
+    def release(self):
+        if self.slots:
+            self.slots.release()
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockOllama"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_chunk(self, body):
+        line = (json.dumps(body) + "\n").encode("utf-8")
+        self.wfile.write(b"%X\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        backend = self.server.backend
+        if self.path == "/api/tags":
+            self.send_json(200, {"models": [{"name": m, "model": m, "size": 1} for m in backend.models]})
+        elif self.path == "/api/ps":
+            self.send_json(200, {"models": [{"name": m, "model": m, "size": 1} for m in backend.models]})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        backend = self.server.backend
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            req = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": "invalid JSON"})
+            return
+        if self.path not in ("/api/generate", "/api/chat", "/api/embed"):
+            self.send_json(404, {"error": "not found"})
+            return
+        if req.get("model") not in backend.models:
+            self.send_json(404, {"error": f"model '{req.get('model')}' not found"})
+            return
+
+        failed = backend.should_fail()
+        backend.acquire()
+        try:
+            if failed:
+                time.sleep(backend.delay())
+                self.send_json(500, {"error": "mock failure (--error-rate)"})
+            elif self.path == "/api/embed":
+                self.embed(backend, req)
+            else:
+                self.generate(backend, req)
+        finally:
+            backend.release()
+
+    def embed(self, backend, req):
+        texts = req.get("input", "")
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(count_tokens(t) for t in texts)
+        started = time.monotonic()
+        time.sleep(backend.delay() + tokens / backend.embed_rate)
+        elapsed = int((time.monotonic() - started) * 1e9)
+        self.send_json(200, {
+            "model": req["model"],
+            "embeddings": [fake_embedding(t, backend.embed_dim) for t in texts],
+            "total_duration": elapsed,
+            "load_duration": 0,
+            "prompt_eval_count": tokens
+        })
+
+    def generate(self, backend, req):
+        """/api/generate and /api/chat: prompt evaluation, then one token per 1/token_rate seconds."""
+        chat = self.path == "/api/chat"
+        prompt_tokens = count_tokens(prompt_text(self.path, req))
+        num_predict = int(req.get("options", {}).get("num_predict") or backend.tokens)
+        load = backend.delay()
+        prompt_seconds = prompt_tokens / backend.prompt_rate
+        started = time.monotonic()
+        time.sleep(load + prompt_seconds)
+
+        def token_body(text, done):
+            body = {"model": req["model"], "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "done": done}
+            if chat:
+                body["message"] = {"role": "assistant", "content": text}
+            else:
+                body["response"] = text
+            return body
+
+        words = [WORDS[i % len(WORDS)] + " " for i in range(num_predict)]
+        stream = req.get("stream", True)
+        if stream:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+        eval_started = time.monotonic()
+        for i, word in enumerate(words):
+            # Sleep to each token's due time, so per-write overhead doesn't slow the rate
+            time.sleep(max(0.0, eval_started + (i + 1) / backend.token_rate - time.monotonic()))
+            if stream:
+                self.send_chunk(token_body(word, False))
+        eval_seconds = time.monotonic() - eval_started
+
+        final = token_body("" if stream else "".join(words), True)
+        final.update({
+            "done_reason": "stop",
+            "total_duration": int((time.monotonic() - started) * 1e9),
+            "load_duration": int(load * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_count": num_predict,
+            "eval_duration": int(eval_seconds * 1e9)
+        })
+        if stream:
+            self.send_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        else:
+            self.send_json(200, final)
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, backend):
+        super().__init__(address, MockHandler)
+        self.backend = backend
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate Ollama hosts for load_balancer.py benchmarks.")
+    parser.add_argument("--hosts", default="127.0.0.1",
+                        help="Comma-separated addresses to listen on, one emulated backend each (e.g. 127.0.0.2,127.0.0.3).")
+    parser.add_argument("--port", type=int, default=OLLAMA_PORT)
+    parser.add_argument("--models", default="qwen:0.5b", help="Comma-separated model names to report and serve.")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds before any work starts on a request (load and scheduling).")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Random +/- fraction applied to --latency.")
+    parser.add_argument("--prompt-rate", type=float, default=2000.0, help="Prompt tokens evaluated per second.")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Generated tokens per second.")
+    parser.add_argument("--tokens", type=int, default=20,
+                        help="Tokens generated per reply unless the request sets options.num_predict.")
+    parser.add_argument("--embed-dim", type=int, default=384)
+    parser.add_argument("--embed-rate", type=float, default=20000.0, help="Embed input tokens per second.")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Requests a backend runs at once, like OLLAMA_NUM_PARALLEL; 0 for no limit.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for jitter and injected errors.")
+    args = parser.parse_args()
+    args.models = [m.strip() for m in args.models.split(",") if m.strip()]
+
+    servers = []
+    for i, host in enumerate(args.hosts.split(",")):
+        # Each address gets its own slots and random stream, like a separate machine
+        server = MockServer((host.strip(), args.port), MockBackend(args, args.seed + i))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        print(f"[DEBUG] Mock Ollama listening on {host.strip()}:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("[DEBUG] Shutting down mock Ollama.")
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    main()
+
+# python3 mock_ollama.py --hosts 127.0.0.2,127.0.0.3 --latency 0.05 --token-rate 50
@@ -1,18 +1,27 @@
 import argparse
 import json
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-import faiss
 import numpy as np 
 
+import embedding_store
+from embed_docs import EMBED_URL, embed_batch
+import index_utils
+import lexical_index
+import metadata_store
+
 
-def get_query_embedding(query: str, model: str) -> np.ndarray:
+def get_query_embedding(query: str, model: str, url: str = EMBED_URL) -> np.ndarray:
     data = {
         "model": model,
         "input": query
     }
 
     #print("[DEBUG] Sending request data to embedding endpoint:", data)
-    response = requests.post("http://localhost:5000/api/embed", json=data)
+    response = requests.post(url, json=data)
     #print("[DEBUG] Response status code:", response.status_code)
     #print("[DEBUG] Raw response text:", response.text)
 
@@ -32,31 +41,144 @@ def get_query_embedding(query: str, model: str) -> np.ndarray:
     # Convert to float32 NumPy array
     return np.array(embedding, dtype=np.float32)
 
+def read_queries(lines):
+    """
+    Queries from a batch file: one per line, either plain text or a JSON object with a
+    "query" field whose other fields (an id, expected answers...) are copied to the output.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            record = json.loads(line)
+            if "query" not in record:
+                raise ValueError(f'Query record without a "query" field: {line[:100]}')
+            yield record
+        else:
+            yield {"query": line}
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def search_batch(records, args, index, params, metadata_list, lexical):
+    """Embed a batch of queries in one /api/embed call (unless --mode lexical) and search them as one matrix."""
+    texts = [r["query"] for r in records]
+    vectors = None
+    if args.mode != "lexical":
+        vectors = np.array(embed_batch(args.url, args.model, texts, args.retries), dtype=np.float32)
+        vectors = index_utils.normalize(vectors, params["metric"])
+    results = lexical_index.retrieve(args.mode, texts, vectors, index, metadata_list, lexical, args.top_k)
+    return [json.dumps({**record, "results": hits}, ensure_ascii=False) for record, hits in zip(records, results)]
+
+def run_batch(args, index, params, metadata_list, lexical):
+    """
+    Answer every query in --queries, writing one JSON line per query in input order.
+    Up to --threads batches are in flight at once, so embedding one batch overlaps
+    searching another; only a bounded window of batches is held in memory.
+    """
+    in_file = sys.stdin if args.queries == "-" else open(args.queries, "r", encoding="utf-8")
+    out_file = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    pending = deque()
+    count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            for batch in batches(read_queries(in_file), args.batch_size):
+                pending.append(pool.submit(search_batch, batch, args, index, params, metadata_list, lexical))
+                while len(pending) > 2 * args.threads or (pending and pending[0].done()):
+                    lines = pending.popleft().result()
+                    out_file.write("\n".join(lines) + "\n")
+                    count += len(lines)
+            while pending:
+                lines = pending.popleft().result()
+                out_file.write("\n".join(lines) + "\n")
+                count += len(lines)
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+        if out_file is not sys.stdout:
+            out_file.close()
+    print(f"[DEBUG] Answered {count} queries", file=sys.stderr)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--query", required=True, help="The query text to embed and search.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--query", help="The query text to embed and search.")
+    source.add_argument("--queries", help='Batch mode: a file of queries, one per line ("-" for stdin); '
+                                          'prints one JSON line of results per query.')
     parser.add_argument("--model", default="qwen:0.5b", help="Which model to use for embedding.")
+    parser.add_argument("--url", default=EMBED_URL, help="Embed endpoint (the load balancer).")
     parser.add_argument("--top_k", type=int, default=3, help="Number of top results.")
+    parser.add_argument("--embeddings", default=None,
+                        help="Exact search straight over an embed_docs.py --format f32 store (memmapped) instead of the Faiss index.")
+    parser.add_argument("--mode", choices=lexical_index.MODES, default="vector",
+                        help="vector: Faiss search; lexical: BM25 keyword search (no embed call); "
+                             "hybrid: both, merged by reciprocal rank.")
+    parser.add_argument("--nprobe", type=int, default=None, help="Override the index's saved nprobe (ivf/ivfpq).")
+    parser.add_argument("--ef-search", type=int, default=None, help="Override the index's saved efSearch (hnsw).")
+    parser.add_argument("--batch-size", type=int, default=64, help="Batch mode: queries per embed call and search.")
+    parser.add_argument("--threads", type=int, default=4, help="Batch mode: batches in flight at once.")
+    parser.add_argument("--retries", type=int, default=3, help="Batch mode: retries per failed embed call.")
+    parser.add_argument("--output", default="-", help='Batch mode: where to write the JSONL results ("-" for stdout).')
     args = parser.parse_args()
+    args.batch_size = max(1, args.batch_size)
+    args.threads = max(1, args.threads)
+    if args.embeddings and args.mode != "vector":
+        parser.error("--embeddings stores are searched by vector only")
+
+    index, params, lexical = None, {"metric": "l2"}, None
+    if args.embeddings:
+        index = embedding_store.MemmapIndex(args.embeddings)
+        metadata_list = embedding_store.MetadataRows(args.embeddings)
+    else:
+        if args.mode != "lexical":
+            index, params = index_utils.load_index(nprobe=args.nprobe, ef_search=args.ef_search)
+        metadata_list = metadata_store.open_metadata()
+    if args.mode != "vector":
+        lexical = lexical_index.LexicalIndex()
+
+    if args.queries:
+        run_batch(args, index, params, metadata_list, lexical)
+        sys.exit(0)
+
+    # Cosine indexes return inner products: higher is closer
+    distance_label = "Similarity" if params["metric"] == "cosine" else "Distance"
+
+    if args.mode != "vector":
+        query_vector_2d = None
+        if args.mode == "hybrid":
+            query_vector_2d = index_utils.normalize(np.array([get_query_embedding(args.query, args.model, args.url)]), params["metric"])
+        hits = lexical_index.retrieve(args.mode, [args.query], query_vector_2d, index, metadata_list, lexical, args.top_k)[0]
+        for rank, hit in enumerate(hits, start=1):
+            scores = [f"{name}: {hit[key]}" for name, key in (("Score", "score"), (distance_label, "distance"), ("BM25", "bm25")) if key in hit]
+            print(f"\n#{rank} | {' | '.join(scores)}")
+            print(f"   Filename: {hit['filename']}")
+            print(f"   Text: {hit['text'][:100]}...")  # truncated
+        sys.exit(0)
 
     # Actually call the function
-    query_vector = get_query_embedding(args.query, args.model)
+    query_vector = get_query_embedding(args.query, args.model, args.url)
 
     # Just to confirm it worked, print out the shape
     #print("[DEBUG] Returned embedding shape:", query_vector.shape)
 
     # Then do something with your embedding...
     # e.g. read a Faiss index, search, etc.
-    index = faiss.read_index("faiss.index")
-    with open("faiss_metadata.json", "r") as mfile:
-        metadata_list = json.load(mfile)
-    
     query_vector_2d = np.array([query_vector], dtype=np.float32)
+    query_vector_2d = index_utils.normalize(query_vector_2d, params["metric"])
     distances, indices = index.search(query_vector_2d, args.top_k)
     
-    for rank, (dist, idx) in enumerate(zip(distances[0], indices[0]), start=1):
-        meta = metadata_list[idx]
-        print(f"\n#{rank} | Distance: {dist}")
+    hit_metadata = index_utils.metadata_for_many(metadata_list, indices[0].tolist())
+    for rank, (dist, meta) in enumerate(zip(distances[0], hit_metadata), start=1):
+        if meta is None:
+            continue
+        print(f"\n#{rank} | {distance_label}: {dist}")
         print(f"   Filename: {meta['filename']}")
         print(f"   Text: {meta['text'][:100]}...")  # truncated
-
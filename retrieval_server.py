@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+import answer_cache
+import index_utils
+import lexical_index
+import metadata_store
+from chat_with_knowledge import DEFAULT_CONTEXT_TOKENS, build_context, chat_with_context
+
+EMBED_URL = "http://localhost:5000/api/embed"
+MODEL_NAME = "qwen:0.5b"
+DEFAULT_TOP_K = 3
+MAX_TOP_K = 1000
+
+class IndexSnapshot:
+    """One loaded index with the metadata, params and BM25 index (if any) that were saved with it."""
+    def __init__(self, index, params, metadata, lexical, signature):
+        self.index = index
+        self.params = params
+        self.metadata = metadata
+        self.lexical = lexical
+        self.signature = signature
+        self.loaded_at = time.time()
+
+class ResidentIndex:
+    """
+    Keeps the index and metadata loaded between queries. A watcher thread notices
+    when build_index.py has swapped in a new faiss.index, loads it next to the old
+    one and then swaps the reference; queries already running finish on the snapshot
+    they started with.
+    """
+    def __init__(self, index_dir="working_data", nprobe=None, ef_search=None):
+        self.index_path = os.path.join(index_dir, "faiss.index")
+        self.params_path = os.path.join(index_dir, "faiss_index_params.json")
+        self.metadata_path = os.path.join(index_dir, "faiss_metadata.sqlite")
+        self.legacy_metadata_path = os.path.join(index_dir, "faiss_metadata.json")
+        self.lexical_path = os.path.join(index_dir, "lexical_index.sqlite")
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.reload_lock = threading.Lock()
+        self.reloads = 0
+        self.reload_errors = 0
+        self.current = self.load()
+
+    def load(self):
+        signature = index_utils.file_signature(self.index_path)
+        started = time.monotonic()
+        index, params = index_utils.load_index(self.index_path, self.params_path, self.nprobe, self.ef_search)
+        # The store's connection keeps reading the file it opened, whatever replaces it later
+        metadata = metadata_store.open_metadata(self.metadata_path, self.legacy_metadata_path)
+        lexical = lexical_index.LexicalIndex(self.lexical_path) if os.path.exists(self.lexical_path) else None
+        print(f"[DEBUG] Loaded {index.ntotal} vectors from {self.index_path} in {time.monotonic() - started:.2f}s")
+        return IndexSnapshot(index, params, metadata, lexical, signature)
+
+    def maybe_reload(self):
+        with self.reload_lock:
+            if index_utils.file_signature(self.index_path) in (None, self.current.signature):
+                return False
+            try:
+                self.current = self.load()
+                self.reloads += 1
+                return True
+            except Exception as e:
+                # Keep serving the old index; try again on the next check
+                print(f"[ERROR] Reloading index failed: {e}")
+                self.reload_errors += 1
+                return False
+
+    def watch(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.maybe_reload()
+        threading.Thread(target=loop, daemon=True).start()
+
+    def search(self, queries, vectors, top_k, mode="vector"):
+        """
+        Hits for each query: dicts of id, distance and/or bm25 (see lexical_index.retrieve)
+        and the stored metadata. vectors is None in lexical mode.
+        """
+        snapshot = self.current
+        if mode != "vector" and snapshot.lexical is None:
+            raise LookupError("This index was built without a BM25 index (build_index.py --no-lexical)")
+        if vectors is not None:
+            vectors = index_utils.normalize(vectors, snapshot.params.get("metric"))
+        return lexical_index.retrieve(mode, queries, vectors, snapshot.index, snapshot.metadata, snapshot.lexical, top_k)
+
+    def stats(self):
+        snapshot = self.current
+        return {
+            "ntotal": snapshot.index.ntotal,
+            "params": snapshot.params,
+            "lexical": snapshot.lexical is not None,
+            "loaded_at": snapshot.loaded_at,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors
+        }
+
+_local = threading.local()
+
+def session():
+    """One keep-alive session per server thread."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+def embed_queries(url, model, queries):
+    resp = session().post(url, json={"model": model, "input": queries})
+    if resp.status_code != 200:
+        raise RuntimeError(f"Embedding server returned {resp.status_code}: {resp.text[:200]}")
+    return np.array(resp.json()["embeddings"], dtype=np.float32)
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    """
+    POST /search {"query": str or [str], "top_k": int, "model": str, "mode": "vector" | "lexical" | "hybrid"}
+        -> {"results": [hit, ...]} (a list of hit lists for a list of queries)
+    POST /rag {"query": str, "top_k": int, "model": str, "mode": str, "context_tokens": int, "cutoff": float}
+        -> {"answer": str, "results": [hit, ...], "context": {...}, "cached": null | "exact" | "similar"}
+        (cutoff only filters vector hits; keyword-only hits have no distance)
+    GET /stats, GET /health
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "RetrievalServer"
+
+    def log_message(self, format, *args):
+        # One line per query would cost more than the search itself
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            stats = {**self.server.index.stats(), "queries": self.server.queries}
+            if self.server.answer_cache:
+                stats["answer_cache"] = self.server.answer_cache.stats()
+            self.send_json(200, stats)
+        else:
+            self.send_json(404, {"error": "Not Found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.path not in ("/search", "/rag"):
+            self.send_json(404, {"error": "Not Found"})
+            return
+        try:
+            req = json.loads(body or b"{}")
+            query = req["query"]
+            top_k = max(1, min(int(req.get("top_k", DEFAULT_TOP_K)), MAX_TOP_K))
+            model = req.get("model", self.server.model)
+            context_tokens = int(req.get("context_tokens", DEFAULT_CONTEXT_TOKENS))
+            cutoff = None if req.get("cutoff") is None else float(req["cutoff"])
+            mode = req.get("mode", "vector")
+            if mode not in lexical_index.MODES:
+                raise ValueError(mode)
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": 'Expected a JSON body with a "query" (and a "mode" of vector, lexical or hybrid)'})
+            return
+        if self.path == "/rag" and not isinstance(query, str):
+            self.send_json(400, {"error": "/rag takes a single query string"})
+            return
+
+        started = time.monotonic()
+        queries = [query] if isinstance(query, str) else query
+        vectors = None
+        if mode != "lexical":
+            try:
+                vectors = embed_queries(self.server.embed_url, model, queries)
+            except Exception as e:
+                self.send_json(502, {"error": str(e)})
+                return
+        embedded = time.monotonic()
+        try:
+            results = self.server.index.search(queries, vectors, top_k, mode)
+        except LookupError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        searched = time.monotonic()
+        self.server.count_query()
+
+        timings = {"embed_ms": (embedded - started) * 1000, "search_ms": (searched - embedded) * 1000}
+        if self.path == "/search":
+            self.send_json(200, {"results": results[0] if isinstance(query, str) else results, "timings": timings})
+            return
+
+        snapshot = self.server.index.current
+        docs, context = build_context(results[0], context_tokens, cutoff, snapshot.params.get("metric", "l2"))
+        doc_ids = [doc["id"] for doc in docs]
+        vector = None if vectors is None else vectors[0]
+        cache = self.server.answer_cache
+        if cache:
+            cache.check_fingerprint(snapshot.signature)
+            answer, match = cache.get(model, doc_ids, query, vector)
+            if answer is not None:
+                timings["chat_ms"] = (time.monotonic() - searched) * 1000
+                self.send_json(200, {"answer": answer, "results": docs, "context": context, "cached": match,
+                                     "timings": timings})
+                return
+        try:
+            resp = chat_with_context(model, query, docs, session=session(), quiet=True, url=self.server.chat_url)
+        except Exception as e:
+            self.send_json(502, {"error": str(e), "results": results[0]})
+            return
+        timings["chat_ms"] = (time.monotonic() - searched) * 1000
+        context["prompt_eval_count"] = resp.get("prompt_eval_count")
+        answer = resp["message"]["content"]
+        if cache:
+            cache.put(model, doc_ids, query, answer, vector)
+        self.send_json(200, {"answer": answer, "results": docs, "context": context, "cached": None, "timings": timings})
+
+def chat_url_for(embed_url):
+    """The /api/chat endpoint on the same balancer as embed_url."""
+    return embed_url.rsplit("/api/", 1)[0] + "/api/chat"
+
+class RetrievalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, index, embed_url, model, answer_cache=None, chat_url=None):
+        super().__init__(address, RetrievalHandler)
+        self.index = index
+        self.answer_cache = answer_cache
+        self.embed_url = embed_url
+        self.chat_url = chat_url or chat_url_for(embed_url)
+        self.model = model
+        self.queries = 0
+        self.queries_lock = threading.Lock()
+
+    def count_query(self):
+        with self.queries_lock:
+            self.queries += 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve /search and /rag from a resident Faiss index.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--index-dir", default="working_data",
+                        help="Where build_index.py wrote faiss.index, faiss_metadata.sqlite and faiss_index_params.json.")
+    parser.add_argument("--embed-url", default=EMBED_URL, help="Embed endpoint (the load balancer).")
+    parser.add_argument("--chat-url", default=None,
+                        help="Chat endpoint for /rag (default: /api/chat on the --embed-url host).")
+    parser.add_argument("--model", default=MODEL_NAME, help="Default model for embedding and chat.")
+    parser.add_argument("--nprobe", type=int, default=None, help="Override the index's saved nprobe (ivf/ivfpq).")
+    parser.add_argument("--ef-search", type=int, default=None, help="Override the index's saved efSearch (hnsw).")
+    parser.add_argument("--reload-interval", type=float, default=2.0,
+                        help="Seconds between checks for a rebuilt index (0 disables hot reload).")
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="Answer repeat /rag questions (same model, same retrieved docs) from a cache.")
+    parser.add_argument("--answer-cache-file", default=answer_cache.ANSWER_CACHE_PATH)
+    parser.add_argument("--answer-cache-ttl", type=float, default=answer_cache.DEFAULT_TTL,
+                        help="Seconds a cached answer stays valid.")
+    parser.add_argument("--answer-cache-entries", type=int, default=answer_cache.DEFAULT_MAX_ENTRIES,
+                        help="Answers kept before the least recently used are evicted.")
+    parser.add_argument("--answer-cache-similarity", type=float, default=answer_cache.DEFAULT_SIMILARITY,
+                        help="Also reuse the answer to a past question at least this similar (cosine) "
+                             "that retrieved the same docs; 0 for exact repeats only.")
+    args = parser.parse_args()
+
+    cache = None
+    if args.answer_cache:
+        cache = answer_cache.AnswerCache(args.answer_cache_file, args.answer_cache_ttl,
+                                         args.answer_cache_entries, args.answer_cache_similarity,
+                                         source=os.path.abspath(os.path.join(args.index_dir, "faiss.index")))
+
+    index = ResidentIndex(args.index_dir, args.nprobe, args.ef_search)
+    if args.reload_interval > 0:
+        index.watch(args.reload_interval)
+
+    server = RetrievalServer((args.host, args.port), index, args.embed_url, args.model, cache, args.chat_url)
+    print(f"[DEBUG] Retrieval server listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("[DEBUG] Shutting down retrieval server.")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
+
+# python3 retrieval_server.py
+# curl http://localhost:5001/search -d '{"query": "how many fish did frank catch?", "top_k": 3}'
+# curl http://localhost:5001/rag -d '{"query": "how many fish did frank catch?"}'
@@ -1,31 +1,179 @@
-import os
+import argparse
+import hashlib
 import json
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing import Pool
+
+READ_BLOCK_BYTES = 1024 * 1024
+DEFAULT_MAX_PART_BYTES = 8 * 1024 * 1024
+
+def find_files(data_dir, extensions, recursive):
+    """Relative paths of matching files under data_dir, in a stable order."""
+    found = []
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.endswith(extensions):
+                found.append(os.path.relpath(os.path.join(root, filename), data_dir))
+        if not recursive:
+            break
+    return found
+
+def split_point(buf, limit):
+    """Where to end a part of at most limit bytes: after the last newline or space if there is one."""
+    for sep in (b"\n", b" "):
+        cut = buf.rfind(sep, limit // 2, limit)
+        if cut != -1:
+            return cut + 1
+    # No whitespace: don't cut through a UTF-8 sequence
+    cut = limit
+    while cut > 1 and (buf[cut] & 0xC0) == 0x80:
+        cut -= 1
+    return cut
+
+def flatten_file(job):
+    """
+    Worker: stream one file in blocks, hashing it and spooling its records to a temp
+    file, so memory stays at about one part whatever the file size. Files bigger than
+    max_part_bytes become several records with "chunk" (part number) and "offset"
+    (byte offset into the file). Returns (relpath, sha256, spool path, records).
+    """
+    data_dir, relpath, spool_dir, max_part_bytes = job
+    digest = hashlib.sha256()
+    spool = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=spool_dir, suffix=".jsonl", delete=False)
+    records = 0
+    part_start = 0
+
+    def emit(data, final):
+        nonlocal records, part_start
+        # Flatten newlines; json.dumps does all the escaping the text needs
+        record = {"filename": relpath, "text": data.decode("utf-8", errors="replace").replace("\n", " ")}
+        if records or not final:
+            record["chunk"] = records
+            record["offset"] = part_start
+        spool.write(json.dumps(record) + "\n")
+        records += 1
+        part_start += len(data)
+
+    with open(os.path.join(data_dir, relpath), "rb") as f, spool:
+        buf = b""
+        while True:
+            block = f.read(READ_BLOCK_BYTES)
+            if not block:
+                break
+            digest.update(block)
+            buf += block
+            while len(buf) > max_part_bytes:
+                cut = split_point(buf, max_part_bytes)
+                emit(buf[:cut], False)
+                buf = buf[cut:]
+        if buf or not records:
+            emit(buf, True)
+
+    return relpath, digest.hexdigest(), spool.name, records
+
+def load_manifest(path):
+    if path and os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(path, manifest):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Flatten text files into documents.jsonl records.")
+    parser.add_argument("--data-dir", default="working_data")
+    parser.add_argument("--output", default="working_data/documents.jsonl", help='Output file ("-" for stdout).')
+    parser.add_argument("--ext", action="append", default=None, help="File extension to include (repeatable, default .txt).")
+    parser.add_argument("--recursive", action="store_true", help="Walk subdirectories too.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes reading and hashing files.")
+    parser.add_argument("--max-part-mb", type=float, default=DEFAULT_MAX_PART_BYTES / (1024 * 1024),
+                        help="Files bigger than this are emitted as several records.")
+    parser.add_argument("--manifest", default=None,
+                        help="Incremental mode: remember (size, mtime, sha256) per file here and emit only new "
+                             "or changed files, plus {\"filename\", \"deleted\": true} for removed ones.")
+    parser.add_argument("--manifest-out", default=None,
+                        help="Where this run's manifest goes (default MANIFEST.new). --manifest only changes "
+                             "on --commit-manifest, so a failed downstream step re-emits the same files next run.")
+    parser.add_argument("--commit-manifest", action="store_true",
+                        help="Promote --manifest-out to --manifest and exit; run it once the index update succeeded.")
+    args = parser.parse_args()
+    if (args.manifest_out or args.commit_manifest) and not args.manifest:
+        parser.error("--manifest-out and --commit-manifest need --manifest")
+    manifest_out = args.manifest_out or (args.manifest and args.manifest + ".new")
+
+    if args.commit_manifest:
+        if not os.path.exists(manifest_out):
+            print(f"No staged manifest at {manifest_out}; run the flattener first.", file=sys.stderr)
+            sys.exit(1)
+        os.replace(manifest_out, args.manifest)
+        print(f"[DEBUG] Committed {manifest_out} to {args.manifest}", file=sys.stderr)
+        return
 
-# Define directories and files
-data_dir = "working_data"
-output_file = "working_data/documents.jsonl"
+    extensions = tuple(args.ext or [".txt"])
+    max_part_bytes = max(1, int(args.max_part_mb * 1024 * 1024))
+    old_manifest = load_manifest(args.manifest)
+    manifest = {}
 
-with open(output_file, "w", encoding="utf-8") as out_file:
-    for filename in os.listdir(data_dir):
-        if filename.endswith(".txt"):
-            file_path = os.path.join(data_dir, filename)
+    # Unchanged size and mtime means unchanged file; don't even open it
+    jobs = []
+    for relpath in find_files(args.data_dir, extensions, args.recursive):
+        st = os.stat(os.path.join(args.data_dir, relpath))
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        known = old_manifest.get(relpath)
+        if known and known["size"] == entry["size"] and known["mtime"] == entry["mtime"]:
+            manifest[relpath] = known
+            continue
+        manifest[relpath] = entry
+        jobs.append(relpath)
 
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read()
+    out_dir = os.path.dirname(os.path.abspath(args.output)) if args.output != "-" else None
+    spool_dir = tempfile.mkdtemp(prefix="flatten-", dir=out_dir)
+    out_file = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    emitted = records = 0
+    try:
+        with Pool(max(1, args.workers)) as pool:
+            work = ((args.data_dir, relpath, spool_dir, max_part_bytes) for relpath in jobs)
+            for relpath, sha256, spool_path, count in pool.imap(flatten_file, work):
+                unchanged = old_manifest.get(relpath, {}).get("sha256") == sha256
+                manifest[relpath]["sha256"] = sha256
+                if not unchanged:
+                    # Write one JSON object per line
+                    with open(spool_path, "r", encoding="utf-8") as spool:
+                        shutil.copyfileobj(spool, out_file)
+                    emitted += 1
+                    records += count
+                os.remove(spool_path)
 
-            # Flatten newlines and escape double quotes
-            flattened_text = content.replace("\n", " ")
-            flattened_text = flattened_text.replace('"', '\\"')
+        removed = sorted(set(old_manifest) - set(manifest))
+        for relpath in removed:
+            out_file.write(json.dumps({"filename": relpath, "deleted": True}) + "\n")
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
 
-            # Create the JSON record
-            record = {
-                "filename": filename,
-                "text": flattened_text
-            }
+    # Staged only: --manifest still describes what the index holds until --commit-manifest
+    if args.manifest:
+        save_manifest(manifest_out, manifest)
 
-            # Write one JSON object per line
-            out_file.write(json.dumps(record) + "\n")
+    print(f"[DEBUG] {len(manifest)} files: {emitted} new or changed ({records} records), "
+          f"{len(removed)} removed, {len(manifest) - emitted} unchanged", file=sys.stderr)
+    if out_file is not sys.stdout:
+        # Print the absolute path to documents.jsonl
+        print(os.path.abspath(args.output))
 
-# Print the absolute path to documents.jsonl
-print(os.path.abspath(output_file))
+if __name__ == "__main__":
+    main()
 
+# python3 working_data_flatener_to_jsonl.py
+# python3 working_data_flatener_to_jsonl.py --recursive --manifest working_data/flatten_manifest.json --output working_data/changed_documents.jsonl
+# python3 working_data_flatener_to_jsonl.py --manifest working_data/flatten_manifest.json --commit-manifest